@@ -0,0 +1,7 @@
+#!/usr/bin/python
+# ======================================================================
+# comPlex benchmarks
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Run the individual benchmarks with python -m bench.<name>
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# ======================================================================
+# comPlex benchmarks
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Attribute access throughput of library items
+#
+# generic:  the unspecialized AbstractTransformAttrib.__get__ chain
+# cold:     specialized getter, first read of each object
+# warm:     specialized getter, memoized value
+# record:   compact __slots__ record
+
+import io
+import sys
+import json
+import time
+import argparse
+
+from comPlex.dt import AbstractTransformAttrib
+from comPlex.stream import XmlStream
+from comPlex.library import Video, create_item
+from comPlex.records import compact
+
+from .synthetic import library_xml
+
+ATTRIBUTES = ("duration", "rating", "views", "title")
+
+
+def load(count):
+    data = library_xml(count).encode("utf-8")
+    return [create_item(None, xml) for xml in XmlStream(io.BytesIO(data))]
+
+
+def run(name, items, read):
+    start = time.perf_counter()
+    for attr in ATTRIBUTES:
+        for item in items:
+            read(item, attr)
+    elapsed = time.perf_counter() - start
+    reads = len(items) * len(ATTRIBUTES)
+    return {"variant": name, "reads": reads, "seconds": elapsed, "reads_per_second": reads / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure attribute access throughput")
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--json", action="store_true", help="Output machine-readable results")
+    args = parser.parse_args()
+
+    descriptors = {attr: Video.__dict__.get(attr) or getattr(Video, attr) for attr in ATTRIBUTES}
+
+    def generic(item, attr):
+        return AbstractTransformAttrib.__get__(descriptors[attr], item)
+
+    results = [run("generic", load(args.count), generic)]
+
+    items = load(args.count)
+    results.append(run("cold", items, getattr))
+    results.append(run("warm", items, getattr))
+
+    records = [compact(item) for item in items]
+    del items
+    results.append(run("record", records, getattr))
+
+    # Sorting is what prompted this
+    items = load(args.count)
+    start = time.perf_counter()
+    items.sort(key=lambda item: item.duration)
+    items.sort(key=lambda item: item.rating)
+    results.append({"variant": "sort", "items": args.count, "seconds": time.perf_counter() - start})
+
+    if args.json:
+        json.dump(results, sys.stdout)
+        print()
+    else:
+        for result in results:
+            if "reads_per_second" in result:
+                print("%(variant)-8s %(reads_per_second)14.0f reads/s" % result)
+            else:
+                print("%(variant)-8s %(seconds)14.3f s for 2 sorts of %(items)d items" % result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# ======================================================================
+# comPlex benchmarks
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# GDM discovery against the stand-in server
+#
+# Starts a FakeServer with a GDMResponder and checks that discover() finds it,
+# reporting the time to the first answer and the probe latency. Exits with 1 if it isn't found.
+
+import sys
+import json
+import time
+import argparse
+
+from comPlex.client import Client
+from comPlex.discovery import iter_search, discover
+
+from .server import FakeServer, GDMResponder, MACHINE_IDENTIFIER
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check GDM discovery against a local responder")
+    parser.add_argument("--latency", type=float, default=0.0, help="Server latency per response in seconds")
+    parser.add_argument("--timeout", type=float, default=0.5, help="Seconds to collect answers for")
+    parser.add_argument("--json", action="store_true", help="Output machine-readable results")
+    args = parser.parse_args()
+
+    server = FakeServer(latency=args.latency).start()
+    responder = GDMResponder(server).start()
+    try:
+        answers = list(iter_search(args.timeout, [responder.target]))
+
+        start = time.perf_counter()
+        servers = discover(Client(), timeout=args.timeout, targets=[responder.target])
+        elapsed = time.perf_counter() - start
+    finally:
+        responder.stop()
+        server.stop()
+
+    found = [conn for conn in servers if conn.uuid == MACHINE_IDENTIFIER and conn.port == server.port]
+    result = {
+        "found": bool(found),
+        "answers": len(answers),
+        "first_answer": answers[0].time if answers else None,
+        "latency": found[0].latency if found else None,
+        "seconds": elapsed,
+    }
+
+    if args.json:
+        json.dump(result, sys.stdout)
+        print()
+    elif found:
+        print("Found %s at %s:%d, first answer after %.1f ms, probe %.1f ms, discover() took %.3f s" % (
+            found[0].name, found[0].host, found[0].port, result["first_answer"] * 1000, result["latency"] * 1000,
+            elapsed))
+    else:
+        print("Stand-in server not found, got %r" % servers)
+
+    if not found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# ======================================================================
+# comPlex benchmarks
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Memory used per Video: lxml-backed library items vs. compact records
+#
+# Each variant is measured in a fresh interpreter, by the growth of the
+# resident set while streaming a synthetic section into a list of items.
+
+import io
+import gc
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+from .synthetic import library_xml
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(variant, count):
+    from comPlex.stream import XmlStream
+    from comPlex.library import create_item
+    from comPlex.records import create_record
+
+    factory = {"items": create_item, "records": create_record}[variant]
+    data = library_xml(count).encode("utf-8")
+
+    gc.collect()
+    before = rss()
+    items = [factory(None, xml) for xml in XmlStream(io.BytesIO(data))]
+    gc.collect()
+    after = rss()
+
+    assert len(items) == count
+    return {"variant": variant, "count": count, "bytes_per_item": (after - before) / count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory per library item")
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--variant", choices=("items", "records"))
+    parser.add_argument("--json", action="store_true", help="Output machine-readable results")
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(measure(args.variant, args.count)))
+        return
+
+    results = []
+    for variant in ("items", "records"):
+        out = subprocess.check_output([sys.executable, "-m", "bench.records",
+                                       "--count", str(args.count), "--variant", variant])
+        results.append(json.loads(out.decode("utf-8")))
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print("%(variant)-8s %(count)8d items %(bytes_per_item)10.0f bytes/item" % result)
+        print("ratio    %.1fx" % (results[0]["bytes_per_item"] / results[1]["bytes_per_item"]))
+
+
+if __name__ == "__main__":
+    main()
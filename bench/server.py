@@ -0,0 +1,382 @@
+#!/usr/bin/python
+# ======================================================================
+# comPlex benchmarks
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Stand-in Plex Media Server serving a synthetic library
+#
+# Serves /, /library/sections, /library/sections/<id>/all (with paging),
+# /library/metadata/<id>[,<id>...], /library/metadata/<id>/children (with paging),
+# thumbnails and /photo/:/transcode. Besides the movie sections there can be a TV section
+# of shows, each with a number of seasons of a number of episodes.
+# Every response can be delayed by a fixed latency and throttled to a bandwidth.
+# A GDMResponder answers discovery M-SEARCHes for it on a UDP port.
+#
+# Run standalone with python -m bench.server --count 100000, it prints the port.
+# With --gdm PORT, it also answers GDM on that UDP port and prints it on a second line.
+
+import sys
+import time
+import socket
+import zlib
+import struct
+import argparse
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import quoteattr
+
+from .synthetic import video_xml, show_xml, season_xml, episode_xml, container_xml
+
+MACHINE_IDENTIFIER = "0123456789abcdef0123456789abcdef01234567"
+
+# Items per chunk of a streamed container
+BATCH = 500
+# Bytes per write when throttling
+WRITE_SIZE = 16384
+
+
+def png(width, height):
+    """ A solid-color RGB PNG """
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    row = b"\x00" + b"\x80\x40\x20" * width
+    return (b"\x89PNG\r\n\x1a\n" +
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(row * height)) +
+            chunk(b"IEND", b""))
+
+
+class Library:
+    """
+    count movies spread over the given number of sections, ratingKeys start at 1
+
+    With shows, section number sections + 1 holds that many shows of seasons seasons with episodes episodes
+    each. Their ratingKeys follow the movies', every show is followed by its seasons and then its episodes.
+    """
+
+    def __init__(self, count, sections=1, shows=0, seasons=4, episodes=10):
+        self.count = count
+        self.sections = sections
+        self.per_section = -(-count // sections)
+
+        self.shows = shows
+        self.seasons = seasons
+        self.episodes = episodes
+        self.tv_section = sections + 1 if shows else None
+        # Keys per show
+        self.block = 1 + seasons + seasons * episodes
+
+    def section_range(self, section):
+        start = (section - 1) * self.per_section + 1
+        return range(start, min(start + self.per_section, self.count + 1))
+
+    def section_of(self, key):
+        return (key - 1) // self.per_section + 1
+
+    def sections_xml(self):
+        sections = ['<Directory key="%d" type="movie" title=%s agent="com.plexapp.agents.none" '
+                    'scanner="Plex Movie Scanner" updatedAt="1420070400" />'
+                    % (section, quoteattr("Synthetic Movies %d" % section)) for section in range(1, self.sections + 1)]
+        if self.shows:
+            sections.append('<Directory key="%d" type="show" title="Synthetic Shows" '
+                            'agent="com.plexapp.agents.none" scanner="Plex Series Scanner" updatedAt="1420070400" />'
+                            % self.tv_section)
+        return container_xml(sections)
+
+    # TV
+    def show_key(self, show):
+        """ The ratingKey of the show-th show, counting from 0 """
+        return self.count + 1 + show * self.block
+
+    def locate(self, key):
+        """ (show key, season index, episode index) of a TV ratingKey, the indices are 0 for the show or season """
+        offset = key - self.count - 1
+        if not 0 <= offset < self.shows * self.block:
+            return None
+        show = key - offset % self.block
+        offset %= self.block
+        if offset <= self.seasons:
+            return show, offset, 0
+        offset -= 1 + self.seasons
+        return show, offset // self.episodes + 1, offset % self.episodes + 1
+
+    def season_key(self, show, season):
+        return show + season
+
+    def episode_key(self, show, season, episode):
+        return show + self.seasons + (season - 1) * self.episodes + episode
+
+    def item_xml(self, key):
+        if 1 <= key <= self.count:
+            return video_xml(key, self.section_of(key))
+        location = self.locate(key)
+        if location is None:
+            return None
+        show, season, episode = location
+        if not season:
+            return show_xml(show, self.tv_section, self.seasons, self.episodes)
+        if not episode:
+            return season_xml(key, show, season, self.tv_section, self.episodes)
+        return episode_xml(key, self.season_key(show, season), show, episode, self.tv_section)
+
+    def children(self, key):
+        """ The number of children of a show or season and a function rendering the i-th, None for other keys """
+        location = self.locate(key)
+        if location is None or location[2]:
+            return None
+        show, season, _ = location
+        if not season:
+            return self.seasons, lambda i: season_xml(self.season_key(show, i + 1), show, i + 1, self.tv_section,
+                                                      self.episodes)
+        return self.episodes, lambda i: episode_xml(self.episode_key(show, season, i + 1), key, show, i + 1,
+                                                    self.tv_section)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately, don't let Nagle hold back the body
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    # Output
+    def write(self, data):
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+        for offset in range(0, len(data), WRITE_SIZE):
+            piece = data[offset:offset + WRITE_SIZE]
+            self.wfile.write(piece)
+            self.sent += len(piece)
+            delay = self.started + self.sent / bandwidth - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def begin(self, status=200, content_type="text/xml;charset=utf-8", length=None):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.started = time.monotonic()
+        self.sent = 0
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if length is None:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def reply(self, body, content_type="text/xml;charset=utf-8"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.begin(200, content_type, len(body))
+        self.write(body)
+
+    def reply_chunks(self, chunks):
+        self.begin()
+        for chunk in chunks:
+            data = chunk.encode("utf-8")
+            if data:
+                self.write(b"%x\r\n" % len(data) + data + b"\r\n")
+        self.write(b"0\r\n\r\n")
+
+    def not_found(self):
+        self.begin(404, length=0)
+
+    def reply_page(self, query, total, render, **attrs):
+        """ Stream the page of a container with total children that query asks for, render(i) gives the i-th """
+        start = int(query.get("X-Plex-Container-Start", self.headers.get("X-Plex-Container-Start", 0)))
+        size = int(query.get("X-Plex-Container-Size", self.headers.get("X-Plex-Container-Size", total)))
+        page = range(start, min(start + size, total))
+
+        def chunks():
+            yield ('<?xml version="1.0" encoding="UTF-8"?><MediaContainer size="%d" totalSize="%d" offset="%d"%s>'
+                   % (len(page), total, start,
+                      "".join(" %s=%s" % (name, quoteattr(str(value))) for name, value in attrs.items())))
+            for batch in range(0, len(page), BATCH):
+                yield "".join(render(i) for i in page[batch:batch + BATCH])
+            yield "</MediaContainer>"
+
+        self.reply_chunks(chunks())
+
+    # Routing
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = url.path.strip("/").split("/") if url.path != "/" else []
+        library = self.server.library
+
+        if not parts:
+            self.reply('<?xml version="1.0" encoding="UTF-8"?><MediaContainer friendlyName="bench" '
+                       'machineIdentifier="%s" version="0.9.12.0" />' % MACHINE_IDENTIFIER)
+        elif parts == ["library", "sections"]:
+            self.reply(library.sections_xml())
+        elif len(parts) == 4 and parts[:2] == ["library", "sections"] and parts[3] == "all" and parts[2].isdigit():
+            self.section_all(int(parts[2]), query)
+        elif len(parts) == 3 and parts[:2] == ["library", "metadata"]:
+            self.metadata(parts[2])
+        elif len(parts) == 4 and parts[:2] == ["library", "metadata"] and parts[3] == "children" \
+                and parts[2].isdigit():
+            self.children(int(parts[2]), query)
+        elif len(parts) == 5 and parts[:2] == ["library", "metadata"] and parts[3] in ("thumb", "art"):
+            self.reply(self.server.image(200, 300), "image/png")
+        elif parts == ["photo", ":", "transcode"]:
+            self.reply(self.server.image(int(query.get("width", 200)), int(query.get("height", 300))), "image/png")
+        else:
+            self.not_found()
+
+    def section_all(self, section, query):
+        library = self.server.library
+        if section == library.tv_section:
+            return self.reply_page(query, library.shows,
+                                   lambda i: show_xml(library.show_key(i), section, library.seasons, library.episodes),
+                                   librarySectionID=section)
+        if not 1 <= section <= library.sections:
+            return self.not_found()
+
+        keys = library.section_range(section)
+        self.reply_page(query, len(keys), lambda i: video_xml(keys[i], section), librarySectionID=section)
+
+    def children(self, key, query):
+        children = self.server.library.children(key)
+        if children is None:
+            return self.not_found()
+        self.reply_page(query, *children, key=key)
+
+    def metadata(self, keys):
+        library = self.server.library
+        try:
+            keys = [int(key) for key in keys.split(",")]
+        except ValueError:
+            return self.not_found()
+        items = [xml for xml in map(library.item_xml, keys) if xml is not None]
+        if not items:
+            return self.not_found()
+        self.reply(container_xml(items))
+
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    HTTP stand-in for a Plex Media Server
+
+    latency is added before every response in seconds, bandwidth limits each response in bytes per second.
+    """
+
+    def __init__(self, count=1000, sections=1, latency=0.0, bandwidth=None, address=("127.0.0.1", 0), shows=0):
+        super().__init__(address, Handler)
+        self.library = Library(count, sections, shows)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._images = {}
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def image(self, width, height):
+        data = self._images.get((width, height))
+        if data is None:
+            data = self._images[width, height] = png(width, height)
+        return data
+
+    def start(self):
+        """ Serve from a background thread """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class GDMResponder:
+    """
+    Answers GDM M-SEARCH datagrams on 127.0.0.1:port on behalf of a FakeServer
+
+    Unlike a real server it doesn't join the multicast group, search it with discover(targets=[responder.target]).
+    """
+
+    def __init__(self, server, port=0, name="bench"):
+        self.server = server
+        self.name = name
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", port))
+        # Check for stop() every so often
+        self.sock.settimeout(0.5)
+        self._stopped = False
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    @property
+    def target(self):
+        return "127.0.0.1", self.port
+
+    def answer(self):
+        return ("HTTP/1.0 200 OK\r\n"
+                "Content-Type: plex/media-server\r\n"
+                "Resource-Identifier: %s\r\n"
+                "Name: %s\r\n"
+                "Port: %d\r\n"
+                "Version: 0.9.12.0\r\n\r\n" % (MACHINE_IDENTIFIER, self.name, self.server.port)).encode("utf-8")
+
+    def serve_forever(self):
+        while not self._stopped:
+            try:
+                data, address = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            if data.startswith(b"M-SEARCH "):
+                self.requests += 1
+                self.sock.sendto(self.answer(), address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic Plex library")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--sections", type=int, default=1)
+    parser.add_argument("--shows", type=int, default=0, help="Shows in an additional TV section")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bytes per second per response")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--gdm", type=int, default=None, metavar="PORT", help="Answer GDM discovery on this UDP port")
+    args = parser.parse_args()
+
+    server = FakeServer(args.count, args.sections, args.latency, args.bandwidth, ("127.0.0.1", args.port),
+                        args.shows)
+    print(server.port)
+    if args.gdm is not None:
+        print(GDMResponder(server, args.gdm).start().port)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# ======================================================================
+# comPlex benchmarks
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# End-to-end benchmarks against the stand-in server
+#
+# For every library size, a bench.server process is started and a Connection measures
+# get_sections, get_items, traversing a section, attribute access, thumbnail fetches and memory.
+# A TV section with about as many episodes as there are movies measures walking shows, seasons
+# and episodes, both streamed page by page and with get_children().
+#
+#   python -m bench.suite --sizes 1000,10000,100000 --latency 0.005 --output results.json
+#   python -m bench.suite --baseline results.json
+#
+# With --baseline, results that got worse by more than --threshold are reported
+# and the exit status is 1.
+
+import gc
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import subprocess
+
+from comPlex import __version__
+from comPlex.client import Client
+from comPlex.connection import Connection
+
+from .records import rss
+
+ATTRIBUTES = ("title", "duration", "rating", "date", "views")
+
+# Shape of the synthetic shows, see bench.server.Library
+SEASONS = 4
+EPISODES = 10
+
+# Benchmarks where a lower value is better
+LOWER_IS_BETTER = ("bytes_per_item", "traversal_rss_growth")
+
+
+class ServerProcess:
+    """ Runs bench.server in a separate interpreter, so it doesn't compete for the GIL """
+
+    def __init__(self, count, latency=0.0, bandwidth=None, shows=0):
+        args = [sys.executable, "-m", "bench.server", "--count", str(count), "--latency", str(latency),
+                "--shows", str(shows)]
+        if bandwidth:
+            args += ["--bandwidth", str(bandwidth)]
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.port = int(self.process.stdout.readline())
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def timed(size, name, operations, unit, function, repeat=1):
+    """ Run function repeat times and return a result with the best time """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"size": size, "benchmark": name, "value": operations / best, "unit": unit,
+            "seconds": best, "operations": operations}
+
+
+def run_size(size, args):
+    results = []
+
+    shows = max(1, size // (SEASONS * EPISODES))
+    with ServerProcess(size, args.latency, args.bandwidth, shows) as server:
+        conn = Connection(Client(), host="127.0.0.1", port=server.port)
+        if not conn.refresh():
+            raise RuntimeError("Benchmark server did not answer")
+
+        results.append(timed(size, "get_sections", 1, "calls/s", conn.get_sections, args.repeat))
+        section, tv = conn.get_sections()
+
+        # Shows, seasons and episodes, every container is a request of its own
+        episodes = shows * SEASONS * EPISODES
+
+        def walk(children):
+            def count():
+                found = sum(1 for show in children(tv) for season in children(show) for _ in children(season))
+                assert found == episodes, found
+            return count
+
+        results.append(timed(size, "child_traversal", episodes, "episodes/s",
+                             walk(lambda container: container.iter_children()), args.repeat))
+        results.append(timed(size, "get_children", episodes, "episodes/s",
+                             walk(lambda container: container.get_children()), args.repeat))
+
+        # Streaming traversal shouldn't grow with the library
+        gc.collect()
+        before = rss()
+        results.append(timed(size, "traversal", size, "items/s",
+                             lambda: sum(1 for _ in section.iter_items()), args.repeat))
+        gc.collect()
+        results.append({"size": size, "benchmark": "traversal_rss_growth", "value": max(rss() - before, 0),
+                        "unit": "bytes"})
+
+        # Memory of loaded items
+        keep = min(size, args.keep)
+        gc.collect()
+        before = rss()
+        items = []
+        for item in section.iter_items():
+            items.append(item)
+            if len(items) >= keep:
+                break
+        gc.collect()
+        results.append({"size": size, "benchmark": "bytes_per_item", "value": (rss() - before) / keep,
+                        "unit": "bytes", "operations": keep})
+
+        def read_attributes():
+            for attr in ATTRIBUTES:
+                for item in items:
+                    getattr(item, attr)
+
+        results.append(timed(size, "attribute_access_cold", keep * len(ATTRIBUTES), "reads/s", read_attributes))
+        results.append(timed(size, "attribute_access", keep * len(ATTRIBUTES), "reads/s", read_attributes,
+                             args.repeat))
+
+        keys = random.Random(size).sample(range(1, size + 1), min(size, args.get_items))
+
+        def get_items():
+            found, missing = conn.get_items(keys)
+            assert len(found) == len(keys) and not missing
+
+        results.append(timed(size, "get_items", len(keys), "items/s", get_items, args.repeat))
+
+        thumbs = items[:args.thumbnails]
+
+        def fetch_thumbnails():
+            for item in thumbs:
+                assert item.get_thumbnail(200, 300)
+
+        results.append(timed(size, "thumbnails", len(thumbs), "images/s", fetch_thumbnails, args.repeat))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Print the change against a baseline, returns the regressions """
+    old = {(result["size"], result["benchmark"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = old.get((result["size"], result["benchmark"]))
+        if previous is None or not previous["value"]:
+            continue
+        change = result["value"] / previous["value"] - 1
+        worse = change > threshold if result["benchmark"] in LOWER_IS_BETTER else change < -threshold
+        print("%-24s %8d %+8.1f%%%s" % (result["benchmark"], result["size"], change * 100,
+                                        "  REGRESSION" if worse else ""))
+        if worse:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark comPlex against a synthetic server")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="Comma-separated library sizes, e.g. 1000,10000,100000,1000000")
+    parser.add_argument("--latency", type=float, default=0.0, help="Server latency per response in seconds")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Server bandwidth in bytes per second")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions, the best time is reported")
+    parser.add_argument("--keep", type=int, default=100000, help="Maximum number of items kept in memory")
+    parser.add_argument("--get-items", type=int, default=1000, help="Number of items fetched by key")
+    parser.add_argument("--thumbnails", type=int, default=100, help="Number of thumbnails fetched")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--json", action="store_true", help="Write the results to stdout as JSON")
+    parser.add_argument("--baseline", help="Compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(",")):
+        for result in run_size(size, args):
+            results.append(result)
+            if not args.json:
+                print("%(benchmark)-24s %(size)8d %(value)14.1f %(unit)s" % result)
+                sys.stdout.flush()
+
+    report = {
+        "meta": {
+            "comPlex": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.json:
+        json.dump(report, sys.stdout)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# ======================================================================
+# comPlex benchmarks
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Synthetic Plex library XML
+
+from xml.sax.saxutils import quoteattr
+
+BASE_TIMESTAMP = 1420070400
+
+GENRES = ("Action", "Comedy", "Drama", "Documentary", "Horror", "Animation", "Thriller")
+
+
+def video_xml(key, section=1):
+    title = "Synthetic Movie %d" % key
+    return (
+        '<Video ratingKey="{key}" key="/library/metadata/{key}" librarySectionID="{section}" type="movie" '
+        'title={title} summary={summary} year="{year}" rating="{rating:.1f}" viewCount="{views}" '
+        'duration="{duration}" originallyAvailableAt="{year}-01-01" thumb="/library/metadata/{key}/thumb/{ts}" '
+        'addedAt="{ts}" updatedAt="{ts}">'
+        '<Media id="{key}" duration="{duration}" bitrate="{bitrate}" width="1920" height="1080" aspectRatio="1.78" '
+        'audioChannels="6" audioCodec="ac3" videoCodec="h264" videoResolution="1080" container="mkv" '
+        'videoFrameRate="24p">'
+        '<Part id="{key}" key="/library/parts/{key}/file.mkv" duration="{duration}" size="{size}" '
+        'file="/media/movies/{key}.mkv" container="mkv" />'
+        '</Media>'
+        '<Genre tag="{genre}" />'
+        '<Role tag="Actor {actor}" />'
+        '</Video>'
+    ).format(
+        key=key,
+        section=section,
+        title=quoteattr(title),
+        summary=quoteattr("The synthetic story of movie number %d." % key),
+        year=1950 + key % 70,
+        rating=(key % 100) / 10,
+        views=key % 3,
+        duration=5400000 + key % 1800000,
+        bitrate=2000 + key % 8000,
+        size=(2000 + key % 8000) * 675000,
+        ts=BASE_TIMESTAMP + key,
+        genre=GENRES[key % len(GENRES)],
+        actor=key % 997,
+    )
+
+
+def show_xml(key, section, seasons, episodes):
+    title = "Synthetic Show %d" % key
+    return (
+        '<Directory ratingKey="{key}" key="/library/metadata/{key}/children" librarySectionID="{section}" '
+        'type="show" title={title} summary={summary} year="{year}" rating="{rating:.1f}" childCount="{seasons}" '
+        'leafCount="{leaves}" viewedLeafCount="0" thumb="/library/metadata/{key}/thumb/{ts}" addedAt="{ts}" '
+        'updatedAt="{ts}"><Genre tag="{genre}" /></Directory>'
+    ).format(
+        key=key,
+        section=section,
+        title=quoteattr(title),
+        summary=quoteattr("The synthetic story of show number %d." % key),
+        year=1950 + key % 70,
+        rating=(key % 100) / 10,
+        seasons=seasons,
+        leaves=seasons * episodes,
+        ts=BASE_TIMESTAMP + key,
+        genre=GENRES[key % len(GENRES)],
+    )
+
+
+def season_xml(key, show, index, section, episodes):
+    return (
+        '<Directory ratingKey="{key}" key="/library/metadata/{key}/children" parentRatingKey="{show}" '
+        'librarySectionID="{section}" type="season" title="Season {index}" index="{index}" leafCount="{episodes}" '
+        'viewedLeafCount="0" thumb="/library/metadata/{key}/thumb/{ts}" addedAt="{ts}" updatedAt="{ts}" />'
+    ).format(key=key, show=show, section=section, index=index, episodes=episodes, ts=BASE_TIMESTAMP + key)
+
+
+def episode_xml(key, season, show, index, section):
+    duration = 1800000 + key % 900000
+    return (
+        '<Video ratingKey="{key}" key="/library/metadata/{key}" parentRatingKey="{season}" '
+        'grandparentRatingKey="{show}" librarySectionID="{section}" type="episode" title={title} '
+        'index="{index}" viewCount="{views}" duration="{duration}" thumb="/library/metadata/{key}/thumb/{ts}" '
+        'addedAt="{ts}" updatedAt="{ts}">'
+        '<Media id="{key}" duration="{duration}" bitrate="4000" width="1280" height="720" aspectRatio="1.78" '
+        'audioChannels="2" audioCodec="aac" videoCodec="h264" videoResolution="720" container="mkv">'
+        '<Part id="{key}" key="/library/parts/{key}/file.mkv" duration="{duration}" size="{size}" '
+        'file="/media/shows/{key}.mkv" container="mkv" />'
+        '</Media>'
+        '</Video>'
+    ).format(
+        key=key,
+        season=season,
+        show=show,
+        section=section,
+        title=quoteattr("Synthetic Episode %d" % key),
+        index=index,
+        views=key % 3,
+        duration=duration,
+        size=duration * 500,
+        ts=BASE_TIMESTAMP + key,
+    )
+
+
+def container_xml(children, total=None, **attrs):
+    children = list(children)
+    attrs["size"] = len(children)
+    if total is not None:
+        attrs["totalSize"] = total
+    return '<?xml version="1.0" encoding="UTF-8"?><MediaContainer %s>%s</MediaContainer>' % (
+        " ".join("%s=%s" % (name, quoteattr(str(value))) for name, value in attrs.items()),
+        "".join(children),
+    )
+
+
+def library_xml(count, section=1):
+    return container_xml((video_xml(key) for key in range(1, count + 1)), count, librarySectionID=section)
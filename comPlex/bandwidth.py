@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Throughput estimation and transcode quality selection
+#
+# The connection reports media and segment downloads; only the time spent receiving the body
+# counts, so a transcoder that is slow to produce a segment doesn't look like a slow link.
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger("comPlex.bandwidth")
+
+# (maxVideoBitrate in kbit/s, videoResolution, videoQuality), best first
+QUALITIES = (
+    (20000, "1920x1080", 100),
+    (12000, "1920x1080", 90),
+    (8000, "1920x1080", 60),
+    (4000, "1280x720", 100),
+    (3000, "1280x720", 90),
+    (2000, "1280x720", 60),
+    (1500, "720x480", 100),
+    (720, "576x320", 75),
+    (320, "576x320", 60),
+)
+
+# Used until something was measured
+DEFAULT_LOCAL = QUALITIES[0]
+DEFAULT_REMOTE = QUALITIES[5]
+
+
+class BandwidthEstimator:
+    """
+    Exponentially weighted moving average of the download throughput of a connection
+
+    Transfers smaller than min_bytes are ignored, their time is mostly latency.
+    Of the estimate, only the fraction headroom is planned for streaming.
+    """
+
+    def __init__(self, alpha=0.3, min_bytes=64 << 10, headroom=0.75):
+        self.alpha = alpha
+        self.min_bytes = min_bytes
+        self.headroom = headroom
+
+        # Bits per second
+        self.estimate = None
+        self.samples = 0
+        self.updated = None
+        self._lock = threading.Lock()
+
+    def observe(self, size, seconds):
+        """ Record a download of size bytes that took seconds """
+        if size < self.min_bytes or seconds <= 0:
+            return
+        rate = size * 8 / seconds
+        with self._lock:
+            if self.estimate is None:
+                self.estimate = rate
+            else:
+                self.estimate += self.alpha * (rate - self.estimate)
+            self.samples += 1
+            self.updated = time.time()
+
+    def reset(self):
+        with self._lock:
+            self.estimate = None
+            self.samples = 0
+            self.updated = None
+
+    def probe(self, connection, path, size=2 << 20, deadline=10.0):
+        """ Measure by downloading the first size bytes of path, e.g. a media part; returns the estimate """
+        response = connection._request("GET", path, headers={"Range": "bytes=0-%d" % (size - 1)},
+                                       valid_codes=(200, 206), stream=True, deadline=deadline)
+        try:
+            start = time.perf_counter()
+            received = 0
+            for chunk in response.iter_content(65536):
+                received += len(chunk)
+                if received >= size:
+                    break
+            self.observe(received, time.perf_counter() - start)
+        finally:
+            response.close()
+        return self.estimate
+
+    # Quality selection
+    def quality(self, local=False):
+        """ The best (maxVideoBitrate, videoResolution, videoQuality) the link can sustain """
+        if self.estimate is None:
+            return DEFAULT_LOCAL if local else DEFAULT_REMOTE
+        usable = self.estimate * self.headroom / 1000
+        for quality in QUALITIES:
+            if quality[0] <= usable:
+                return quality
+        return QUALITIES[-1]
+
+    def max_bitrate(self, local=False):
+        """ The usable bitrate in kbit/s rounded down to a quality level, None for no limit """
+        if self.estimate is None and local:
+            return None
+        return self.quality(local)[0]
+
+    def transcode_options(self, local=False):
+        bitrate, resolution, quality = self.quality(local)
+        return {"maxVideoBitrate": bitrate, "videoResolution": resolution, "videoQuality": quality}
+
+    def __repr__(self):
+        return "<BandwidthEstimator %s>" % ("%.1f Mbit/s" % (self.estimate / 1e6) if self.estimate else "unknown")
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import collections
+
+logger = logging.getLogger("comPlex.cache")
+
+
+class CacheEntry:
+    __slots__ = ("key", "etag", "last_modified", "body")
+
+    def __init__(self, key, etag, last_modified, body):
+        self.key = key
+        self.etag = etag
+        self.last_modified = last_modified
+        self.body = body
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    @property
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Stores response bodies together with their ETag/Last-Modified validators
+
+    Entries live in a size-limited in-memory LRU and, if a path is given, in a size-limited
+    on-disk LRU below it. Entries evicted from memory can be promoted back from disk.
+    """
+
+    def __init__(self, path=None, max_memory=32 << 20, max_disk=256 << 20):
+        self.path = path
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+
+        self._memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.disk_size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.RLock()
+
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.disk_size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    # Lookup
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+
+            entry = self._disk_get(key)
+            if entry is not None:
+                self._memory_put(entry)
+            return entry
+
+    def put(self, key, etag, last_modified, body):
+        entry = CacheEntry(key, etag, last_modified, body)
+        if not etag and not last_modified:
+            # Cannot be revalidated
+            return entry
+
+        with self._lock:
+            self._memory_put(entry)
+            self._disk_put(entry)
+        return entry
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.memory_size = 0
+            if self.path is not None:
+                for entry in os.scandir(self.path):
+                    os.unlink(entry.path)
+                self.disk_size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_size": self.memory_size,
+                "disk_size": self.disk_size,
+            }
+
+    # Memory tier
+    def _memory_put(self, entry):
+        old = self._memory.pop(entry.key, None)
+        if old is not None:
+            self.memory_size -= old.size
+
+        if entry.size > self.max_memory:
+            return
+
+        self._memory[entry.key] = entry
+        self.memory_size += entry.size
+
+        while self.memory_size > self.max_memory:
+            _, evicted = self._memory.popitem(last=False)
+            self.memory_size -= evicted.size
+            self.evictions += 1
+
+    # Disk tier
+    def _disk_file(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _disk_get(self, key):
+        if self.path is None:
+            return None
+
+        filename = self._disk_file(key)
+        try:
+            with open(filename, "rb") as f:
+                header = json.loads(f.readline().decode("utf-8"))
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+
+        if header.get("key") != key:
+            return None
+
+        # Mark as recently used
+        os.utime(filename)
+        return CacheEntry(key, header.get("etag"), header.get("last_modified"), body)
+
+    def _disk_put(self, entry):
+        if self.path is None or entry.size > self.max_disk:
+            return
+
+        filename = self._disk_file(entry.key)
+        header = json.dumps({"key": entry.key, "etag": entry.etag, "last_modified": entry.last_modified})
+
+        try:
+            old_size = os.path.getsize(filename)
+        except OSError:
+            old_size = 0
+
+        tmpname = "%s.%d.tmp" % (filename, threading.get_ident())
+        try:
+            with open(tmpname, "wb") as f:
+                f.write(header.encode("utf-8"))
+                f.write(b"\n")
+                f.write(entry.body)
+            size = os.path.getsize(tmpname)
+            os.replace(tmpname, filename)
+        except OSError as e:
+            logger.warning("Could not write cache file %s: %s" % (filename, e))
+            return
+
+        self.disk_size += size - old_size
+
+        if self.disk_size > self.max_disk:
+            self._disk_evict()
+
+    def _disk_evict(self):
+        files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(self.path) if entry.is_file())
+
+        for _, size, filename in files:
+            if self.disk_size <= self.max_disk:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                continue
+            self.disk_size -= size
+            self.evictions += 1
@@ -9,6 +9,8 @@
 import uuid
 import socket
 import platform
+import threading
+import urllib.parse
 
 import requests
 
@@ -16,9 +18,45 @@ from .transcode import TranscodeSession
 from . import __version__
 
 
+IDENTITY_HEADERS = ("Device", "Product", "Model", "Device-Name",
+                    "Version", "Language", "Provides", "Client-Identifier",
+                    "Platform", "Client-Platform", "Platform-Version")
+
+_hostname = None
+_hostname_lock = threading.Lock()
+
+
+def resolve_hostname(timeout=2.0):
+    """
+    Get the fully qualified name of this machine
+
+    The reverse lookup is only done once, and gives up after timeout seconds,
+    falling back to the plain host name.
+    """
+    global _hostname
+    with _hostname_lock:
+        if _hostname is None:
+            result = [socket.gethostname()]
+
+            def lookup():
+                try:
+                    result[0] = socket.gethostbyaddr(result[0])[0]
+                except OSError:
+                    pass
+
+            thread = threading.Thread(target=lookup, daemon=True)
+            thread.start()
+            thread.join(timeout)
+            _hostname = result[0]
+        return _hostname
+
+
 class Client:
     """
     Holds information about the client application
+
+    The identification headers are computed once and cached until one of the attributes they are
+    made of is assigned to.
     """
     # Should be handled in subclasses
     Device = "comPlex client"
@@ -30,7 +68,7 @@ class Client:
 
     @property
     def DeviceName(self):
-        return socket.gethostbyaddr(socket.gethostname())[0]
+        return resolve_hostname()
 
     @property
     def ClientIdentifier(self):
@@ -49,12 +87,30 @@ class Client:
 
         self.session = requests.Session()
 
+    _identity_attributes = frozenset(name.replace("-", "") for name in IDENTITY_HEADERS) | {"client_id"}
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self._identity_attributes:
+            self.__dict__.pop("_plex_headers", None)
+            self.__dict__.pop("_plex_query", None)
+
     @property
     def plex_headers(self):
-        return {"X-Plex-" + name: getattr(self, name.replace("-", ""))
-                for name in ("Device", "Product", "Model", "Device-Name",
-                             "Version", "Language", "Provides", "Client-Identifier",
-                             "Platform", "Client-Platform", "Platform-Version")}
+        """ The identification headers. Don't modify the returned dict """
+        headers = self.__dict__.get("_plex_headers")
+        if headers is None:
+            headers = {"X-Plex-" + name: getattr(self, name.replace("-", "")) for name in IDENTITY_HEADERS}
+            self._plex_headers = headers
+        return headers
+
+    @property
+    def plex_query(self):
+        """ The identification headers as url-encoded query string """
+        query = self.__dict__.get("_plex_query")
+        if query is None:
+            query = self._plex_query = urllib.parse.urlencode(self.plex_headers)
+        return query
 
     def setup_transcode(self, conn, url, options):
         return TranscodeSession(conn, url)
@@ -5,8 +5,12 @@
 # (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
 # ======================================================================
 
+import io
+import time
 import logging
 import posixpath
+import urllib.parse
+import concurrent.futures
 
 try:
     from lxml import etree
@@ -17,9 +21,18 @@ import requests
 
 from .library import Section, create_item
 from .client import Client
+from .stream import XmlStream
+from .routing import Router
+from .retry import Backoff
+from .metrics import Metrics
+from .bandwidth import BandwidthEstimator
 
 logger = logging.getLogger("comPlex.connection")
 
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# Gateway errors worth retrying
+RETRY_STATUS_CODES = (502, 503, 504)
+
 
 # Exceptions
 class ConnectionError(Exception):
@@ -39,13 +52,32 @@ class InvalidResponseError(ConnectionError):
 
 
 class Connection:
-    def __init__(self, client: Client, uuid=None, name=None, host=None, port=32400, token=None, discovery=None):
+    def __init__(self, client: Client, uuid=None, name=None, host=None, port=32400, token=None, discovery=None,
+                 cache=None, store=None, addresses=(), metrics=None):
         self.client = client
 
+        # Optional ResponseCache for conditional GET requests
+        self.cache = cache
+        # Optional MetadataStore for warm-start and offline browsing
+        self.store = store
+        # Optional MutationQueue, library changes are then sent in the background
+        self.mutations = None
+        # Called with every library item created for this connection
+        self.item_observers = []
+        # Request and parse statistics, may be shared between connections
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Download throughput for connections without a route, see bandwidth
+        self._bandwidth = BandwidthEstimator()
+
         self.uuid = uuid
         self.name = name
-        self.host = host
-        self.port = port
+
+        # Candidate addresses, host:port is tried first, further (host, port) pairs are alternatives
+        self.router = Router(self._probe)
+        if host is not None:
+            self.router.add(host, port)
+        for address in addresses:
+            self.router.add(*address)
 
         if discovery == "myplex":
             self.public_host = host
@@ -58,74 +90,491 @@ class Connection:
 
         self.protocol = "http"
 
+        # Number of items requested per page by iter_xml()
+        self.page_size = 200
+        # Limits for batched requests by get_items()
+        self.max_url_length = 2000
+        self.max_parallel_requests = 4
+
+        # Timeouts in seconds, the deadline covers all retries of a single request
+        self.connect_timeout = 3.0
+        self.read_timeout = 30.0
+        self.deadline = 60.0
+        self.backoff = Backoff()
+
         self.owned = 0
         self.master = 0
         self.class_type = "primary"
         self.plex_home_enabled = False
         self.discovered = False
+        # Round trip time of the discovery probe, in seconds
+        self.latency = None
 
-    def get_url(self, path, *, relative_to="/"):
-        return "%s://%s:%d%s" % (self.protocol, self.host, self.port, posixpath.join(relative_to, path))
+    # The current route
+    @property
+    def host(self):
+        route = self.router.current
+        return route.host if route is not None else None
 
-    def _request(self, method, path, *, valid_codes=(requests.codes.ok,), **kwargs):
-        try:
-            response = self.client.session.request(
-                method,
-                self.get_url(path),
-                params=self.client.plex_headers,
-                **kwargs
-            )
-        except requests.exceptions.ConnectionError as e:
-            logger.error("Host %s is offline or uncontactable. error: %s" % (self.host, e))
-            raise OfflineError(e)
-        except requests.exceptions.ReadTimeout as e:
-            logger.error("Timeout for '%s' on Host %s" % (path, self.host))
-            raise OfflineError(e)
-        else:
-            if response.status_code in valid_codes:
-                return response
-            elif response.status_code == requests.codes.unauthorized:
-                logger.warn("Got 401 Unauthorized - Please log into myplex and check your password")
-                raise UnauthorizedError()
+    @property
+    def port(self):
+        route = self.router.current
+        return route.port if route is not None else None
+
+    @property
+    def local(self):
+        """ Whether the current route is on the local network """
+        route = self.router.current
+        return route is not None and route.local
+
+    @property
+    def bandwidth(self):
+        """ The throughput estimate of the current route, a LAN estimate doesn't carry over to a relay """
+        route = self.router.current
+        return route.bandwidth if route is not None else self._bandwidth
+
+    def add_address(self, host, port=32400):
+        """ Add an alternative address for the server """
+        self.router.add(host, port)
+
+    def get_url(self, path, *, relative_to="/", route=None):
+        if route is None:
+            route = self.router.current
+        return "%s://%s:%d%s" % (self.protocol, route.host, route.port, posixpath.join(relative_to, path))
+
+    def _probe(self, route, timeout):
+        """ Check that the server answers on route """
+        response = self.client.session.get("%s?%s" % (self.get_url("/", route=route), self.client.plex_query),
+                                           timeout=timeout)
+        if response.status_code != requests.codes.ok:
+            return False
+        # Make sure it's still the same server
+        return self.uuid is None or etree.fromstring(response.content).get("machineIdentifier") == self.uuid
+
+    def _request(self, method, path, *, params=None, valid_codes=(requests.codes.ok,), deadline=None, measure=False,
+                 **kwargs):
+        """
+        Send a request to the current route
+
+        Idempotent requests are retried with backoff on connection errors, timeouts and gateway errors,
+        as long as the deadline (in seconds, defaults to self.deadline) allows. A connection failure
+        switches to another route if there is one. Hosts that keep failing are skipped by their
+        circuit breaker, raising OfflineError right away until it lets a trial request through.
+        With measure, the download feeds the bandwidth estimate; use it for media and segments.
+        """
+        expires = time.monotonic() + (deadline if deadline is not None else self.deadline)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        delays = self.backoff.delays() if idempotent else iter(())
+        failovers = len(self.router) - 1
+        timeout = kwargs.pop("timeout", None)
+        # Routes whose breaker already counted a failure of this request, retries don't count again
+        failed = set()
+
+        while True:
+            route = self.router.current
+            error = None
+
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                self.metrics.observe_error(method, path, "deadline")
+                raise OfflineError("Deadline for '%s' on Host %s exceeded" % (path, route.host))
+
+            if not route.breaker.allow():
+                if failovers > 0 and self.router.fail(route) is not None:
+                    failovers -= 1
+                    continue
+                self.metrics.observe_error(method, path, "breaker_open")
+                raise OfflineError("Host %s is offline" % route.host)
+
+            url = "%s%s%s" % (self.get_url(path, route=route), "&" if "?" in path else "?", self.client.plex_query)
+
+            start = time.perf_counter()
+            try:
+                response = self.client.session.request(
+                    method,
+                    url,
+                    params=params,
+                    timeout=timeout or (min(self.connect_timeout, remaining), min(self.read_timeout, remaining)),
+                    **kwargs
+                )
+            except requests.exceptions.ConnectionError as e:
+                logger.error("Host %s is offline or uncontactable. error: %s" % (route.host, e))
+                self.metrics.observe_error(method, path, "offline")
+                if route not in failed:
+                    failed.add(route)
+                    route.breaker.failure()
+                # Fail over to another address, repeating the request if that is safe
+                if failovers > 0 and self.router.fail(route) is not None and idempotent:
+                    failovers -= 1
+                    continue
+                error = OfflineError(e)
+            except requests.exceptions.ReadTimeout as e:
+                logger.error("Timeout for '%s' on Host %s" % (path, route.host))
+                self.metrics.observe_error(method, path, "timeout")
+                if route not in failed:
+                    failed.add(route)
+                    route.breaker.failure()
+                error = OfflineError(e)
             else:
-                logger.error("Got unexpected status code for '%s' on %s: %s" % (path, self.host, response.status_code))
-                raise InvalidResponseError()
+                route.breaker.success()
+                elapsed = time.perf_counter() - start
+                size = 0 if kwargs.get("stream") else len(response.content)
+                self.metrics.observe_request(method, path, elapsed, response.status_code, size)
+                if response.status_code in valid_codes:
+                    if measure:
+                        # Only the body counts, waiting for the headers is latency
+                        route.bandwidth.observe(size, elapsed - response.elapsed.total_seconds())
+                    return response
+                elif response.status_code == requests.codes.unauthorized:
+                    logger.warn("Got 401 Unauthorized - Please log into myplex and check your password")
+                    self.metrics.observe_error(method, path, "unauthorized")
+                    raise UnauthorizedError()
+                elif response.status_code in RETRY_STATUS_CODES:
+                    logger.warning("Got %s for '%s' on %s" % (response.status_code, path, route.host))
+                    self.metrics.observe_error(method, path, "status")
+                    response.close()
+                    error = InvalidResponseError(response.status_code)
+                else:
+                    logger.error("Got unexpected status code for '%s' on %s: %s" %
+                                 (path, route.host, response.status_code))
+                    self.metrics.observe_error(method, path, "status")
+                    raise InvalidResponseError(response.status_code)
+
+            delay = next(delays, None)
+            if delay is None or time.monotonic() + delay >= expires:
+                raise error
+            logger.info("Retrying '%s' on %s in %.2f seconds" % (path, route.host, delay))
+            time.sleep(delay)
+
+    def _cached_request(self, path, params=None, deadline=None):
+        # Key by server rather than address, so switching routes keeps the cache valid
+        key = "plex://%s%s" % (self.uuid, path) if self.uuid is not None else self.get_url(path)
+        if params:
+            key += "?" + urllib.parse.urlencode(sorted(params.items()))
+
+        entry = self.cache.get(key)
+        response = self._request("GET", path, params=params,
+                                 headers=entry.validators if entry is not None else None,
+                                 valid_codes=(requests.codes.ok, requests.codes.not_modified), deadline=deadline)
+
+        if response.status_code == requests.codes.not_modified and entry is not None:
+            self.cache.hit()
+            self.metrics.observe_cache("GET", path, True)
+            return entry
 
-    def xml(self, path, *, method="GET"):
-        response = self._request(method, path, stream=True)
+        self.cache.miss()
+        self.metrics.observe_cache("GET", path, False)
+        return self.cache.put(key, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                              response.content)
+
+    def xml(self, path, *, method="GET", params=None, deadline=None):
+        if self.cache is not None and method == "GET":
+            entry = self._cached_request(path, params, deadline)
+            # Only the body is cached: a parsed tree takes many times its size, and callers
+            # modify the elements they get (e.g. views += 1), so each one gets a fresh tree
+            start = time.perf_counter()
+            tree = etree.parse(io.BytesIO(entry.body))
+            self.metrics.observe_body(method, path, seconds=time.perf_counter() - start,
+                                      elements=len(tree.getroot()))
+            return tree
+
+        response = self._request(method, path, params=params, stream=True, deadline=deadline)
         # requests + etree = magic!
         response.raw.decode_content = True
+        start = time.perf_counter()
         tree = etree.parse(response.raw)
+        self.metrics.observe_body(method, path, response.raw.tell(), time.perf_counter() - start,
+                                  len(tree.getroot()))
         response.close()
         return tree
 
-    def ping(self, path, *, method="GET"):
-        return bool(self._request(method, path))
+    def stream(self, path, *, method="GET", params=None, tags=("Directory", "Video"), clear=False):
+        """
+        Parse a container incrementally, see XmlStream
+
+        The response is released once the stream has been exhausted or closed.
+        """
+        if self.cache is not None and method == "GET":
+            # The stream takes the document apart, so never hand it the cached tree
+            entry = self._cached_request(path, params)
+            stream = XmlStream(io.BytesIO(entry.body), tags, clear=clear,
+                               close=lambda: self.metrics.observe_body(method, path, 0, stream.parse_time,
+                                                                       stream.count))
+            return stream
+
+        response = self._request(method, path, params=params, stream=True)
+        response.raw.decode_content = True
+
+        def close():
+            self.metrics.observe_body(method, path, response.raw.tell(), stream.parse_time, stream.count)
+            response.close()
+
+        stream = XmlStream(response.raw, tags, clear=clear, close=close)
+        return stream
+
+    def iter_xml(self, path, *, page_size=None, start=0):
+        """
+        Iterate over the children of a container, fetching it one page at a time
+
+        The total number of items is taken from the totalSize attribute of the first page.
+        Servers that ignore the paging parameters are handled by stopping after the first response.
+        Paging counts every child of the container, including those of tags that aren't yielded.
+        """
+        if page_size is None:
+            page_size = self.page_size
+
+        total = None
+        while total is None or start < total:
+            stream = self.stream(path, params={"X-Plex-Container-Start": start,
+                                               "X-Plex-Container-Size": page_size})
+
+            yield from stream
+
+            if total is None:
+                if stream.root is None or "totalSize" not in stream.root.attrib:
+                    return
+                total = int(stream.root.get("totalSize"))
+
+            if not stream.count:
+                return
+            start += stream.count
+
+    def ping(self, path, *, method="GET", deadline=None):
+        return bool(self._request(method, path, deadline=deadline))
 
     def refresh(self):
+        # An explicit refresh always tries again
+        for route in self.router.routes:
+            route.breaker.reset()
+        if len(self.router) > 1:
+            self.router.race()
+
         try:
             tree = self.xml("/").getroot()
         except ConnectionError:
             self.discovered = False
+            if self.store is not None and self.uuid is None:
+                known = self.store.find_server(self.host, self.port)
+                if known is not None:
+                    self.uuid, self.name = known
             return False
         else:
-            self.name = tree.get('friendlyName')
-            self.uuid = tree.get('machineIdentifier')
-            self.owned = 1
-            self.master = 1
-            self.class_type = tree.get('serverClass', 'primary')
-            self.plex_home_enabled = tree.get('multiuser') == '1'
-            self.discovered = True
+            self.identify(tree)
             return True
 
+    def identify(self, root):
+        """ Take the server's identity from its root container """
+        self.name = root.get('friendlyName')
+        self.uuid = root.get('machineIdentifier')
+        self.owned = 1
+        self.master = 1
+        self.class_type = root.get('serverClass', 'primary')
+        self.plex_home_enabled = root.get('multiuser') == '1'
+        self.discovered = True
+        if self.store is not None:
+            self.store.put_server(self.uuid, self.name, self.host, self.port)
+
+    @property
+    def _use_store(self):
+        return self.store is not None and self.uuid is not None
+
+    def children(self, path, updated_at=None):
+        """
+        Get the child elements of a container
+
+        With a store, a copy stored for the same updatedAt is returned without contacting the server,
+        and a stale copy is used if the server is offline.
+        """
+        if not self._use_store:
+            return list(self.stream(path))
+
+        if updated_at is not None:
+            children = self.store.get_children(self.uuid, path, updated_at)
+            if children is not None:
+                return children
+
+        try:
+            children = list(self.stream(path))
+        except OfflineError:
+            children = self.store.get_children(self.uuid, path)
+            if children is None:
+                raise
+            logger.warning("Using stored copy of '%s' from %s" % (path, self.name))
+        else:
+            self.store.put_children(self.uuid, path, children, updated_at)
+        return children
+
+    def iter_children(self, path, updated_at=None, *, page_size=None):
+        """
+        Like children(), but yields the elements as they are fetched page by page
+        """
+        if not self._use_store:
+            yield from self.iter_xml(path, page_size=page_size)
+            return
+
+        if updated_at is not None:
+            children = self.store.get_children(self.uuid, path, updated_at)
+            if children is not None:
+                yield from children
+                return
+
+        children = []
+        try:
+            for xml in self.iter_xml(path, page_size=page_size):
+                children.append(xml)
+                yield xml
+        except OfflineError:
+            stored = self.store.get_children(self.uuid, path) if not children else None
+            if stored is None:
+                raise
+            logger.warning("Using stored copy of '%s' from %s" % (path, self.name))
+            yield from stored
+        else:
+            self.store.put_children(self.uuid, path, children, updated_at)
+
+    def children_page(self, path, start=0, updated_at=None, *, page_size=None, collected=None):
+        """
+        Like iter_children(), but fetches a single page with a request of its own
+
+        Nothing is held open between pages, so callers can take their time asking for the next one.
+        Returns the children and the start of the next page, None after the last one. The stored copy
+        is returned whole as the first page, if it is current or the server is offline.
+        collected is a list kept by the caller across pages, the children are written to the store
+        once the last page arrived.
+        """
+        if page_size is None:
+            page_size = self.page_size
+
+        if self._use_store and start == 0 and updated_at is not None:
+            children = self.store.get_children(self.uuid, path, updated_at)
+            if children is not None:
+                return children, None
+
+        try:
+            stream = self.stream(path, params={"X-Plex-Container-Start": start, "X-Plex-Container-Size": page_size})
+            children = list(stream)
+        except OfflineError:
+            stored = self.store.get_children(self.uuid, path) if self._use_store and start == 0 else None
+            if stored is None:
+                raise
+            logger.warning("Using stored copy of '%s' from %s" % (path, self.name))
+            return stored, None
+
+        # Same rules as iter_xml()
+        total = stream.root.get("totalSize") if stream.root is not None else None
+        end = start + stream.count
+        if not stream.count or total is None or end >= int(total):
+            end = None
+
+        if collected is not None:
+            collected.extend(children)
+            if end is None and self._use_store:
+                self.store.put_children(self.uuid, path, collected, updated_at)
+        return children, end
+
+    def container(self, path, updated_at=None):
+        """
+        Like children(), but returns a MediaContainer element
+        """
+        if not self._use_store:
+            return self.xml(path).getroot()
+        root = etree.Element("MediaContainer")
+        root.extend(self.children(path, updated_at))
+        return root
+
     def get_sections(self):
-        return [Section(self, section) for section in self.xml("/library/sections").getroot()]
+        if not self._use_store:
+            return [Section(self, section) for section in self.xml("/library/sections").getroot()]
+
+        try:
+            sections = list(self.xml("/library/sections").getroot())
+        except OfflineError:
+            logger.warning("Using stored sections of %s" % self.name)
+            sections = self.store.get_sections(self.uuid)
+        else:
+            self.store.put_sections(self.uuid, sections)
+        return [Section(self, section) for section in sections]
 
     def get_item(self, key):
-        return create_item(self, self.xml("/library/metadata/%s" % key).getroot())
+        if not self._use_store:
+            return create_item(self, self.xml("/library/metadata/%s" % key).getroot()[0])
+
+        try:
+            xml = self.xml("/library/metadata/%s" % key).getroot()[0]
+        except OfflineError:
+            xml = self.store.get_item(self.uuid, key)
+            if xml is None:
+                raise
+        else:
+            self.store.put_items(self.uuid, (xml,))
+        return create_item(self, xml)
+
+    def _chunk_keys(self, path, keys):
+        budget = self.max_url_length - len(self.get_url(path)) - len(self.client.plex_query) - 1
+        chunk = []
+        length = 0
+        for key in keys:
+            if chunk and length + len(key) + 1 > budget:
+                yield chunk
+                chunk = []
+                length = 0
+            chunk.append(key)
+            length += len(key) + 1
+        if chunk:
+            yield chunk
+
+    def get_items(self, keys):
+        """
+        Fetch many items by ratingKey
+
+        The keys are requested as comma-separated lists, split to fit into max_url_length,
+        with up to max_parallel_requests requests in flight at once.
+        Returns a list of items in the order of keys, and a list of keys that weren't found.
+        """
+        keys = [str(key) for key in keys]
+        unique = list(dict.fromkeys(keys))
+
+        def fetch(chunk):
+            try:
+                return list(self.stream("/library/metadata/" + ",".join(chunk)))
+            except InvalidResponseError as e:
+                # The server answers 404 if none of the keys exist
+                if e.args and e.args[0] == requests.codes.not_found:
+                    return []
+                raise
+
+        found = {}
+        with concurrent.futures.ThreadPoolExecutor(self.max_parallel_requests) as executor:
+            for elements in executor.map(fetch, self._chunk_keys("/library/metadata/", unique)):
+                for xml in elements:
+                    found[xml.get("ratingKey")] = xml
+
+        if self._use_store:
+            self.store.put_items(self.uuid, found.values())
+
+        items = {key: create_item(self, xml) for key, xml in found.items()}
+        return [items[key] for key in keys if key in items], [key for key in keys if key not in items]
 
     def get_metadata(self, id):
         return self.xml('/library/metadata/%s' % id)
 
+    def get_photo_transcode_path(self, path, width, height):
+        """
+        Path of a server-scaled version of the image at path
+        """
+        return "/photo/:/transcode?%s" % urllib.parse.urlencode({
+            "url": "http://127.0.0.1:32400%s" % path,
+            "width": width,
+            "height": height,
+        })
+
+    def get_photo(self, path, width=None, height=None):
+        """
+        Download an image, scaled to fit into width x height by the server if given
+        """
+        if width and height:
+            path = self.get_photo_transcode_path(path, width, height)
+        return self._request("GET", path).content
+
     def get_universal_transcode(self, url, **kwds):
         return self.client.setup_transcode(url, kwds)
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Choosing how to play a video
+#
+# A ClientProfile describes what the player can handle. The DecisionEngine ranks the
+# formats of a video as direct play (the file as is), direct stream (the streams remuxed
+# by the server) or transcode candidates, and can have the server confirm its choice.
+
+import logging
+import threading
+import collections
+
+logger = logging.getLogger("comPlex.decision")
+
+DIRECT_PLAY = "directplay"
+DIRECT_STREAM = "directstream"
+TRANSCODE = "transcode"
+
+# Preference order
+KINDS = (DIRECT_PLAY, DIRECT_STREAM, TRANSCODE)
+
+# Server decision codes
+DECISION_OK = 1000
+
+
+class ClientProfile:
+    """
+    What a player can decode
+
+    containers, video_codecs and audio_codecs are the names used by the server, e.g. "mkv", "h264", "aac".
+    None means no limit; max_bitrate is in kbit/s. Transcodes are requested at transcode_resolution,
+    or at whatever the connection's bandwidth allows if it is None.
+    """
+
+    def __init__(self, name, containers=(), video_codecs=(), audio_codecs=(), max_height=None, max_bitrate=None,
+                 max_audio_channels=None, transcode_resolution=None, multiple_parts=False):
+        self.name = name
+        self.containers = frozenset(containers)
+        self.video_codecs = frozenset(video_codecs)
+        self.audio_codecs = frozenset(audio_codecs)
+        self.max_height = max_height
+        self.max_bitrate = max_bitrate
+        self.max_audio_channels = max_audio_channels
+        self.transcode_resolution = transcode_resolution
+        # Whether the player can play all parts of a multi-part media one after the other
+        self.multiple_parts = multiple_parts
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "containers": sorted(self.containers),
+            "video_codecs": sorted(self.video_codecs),
+            "audio_codecs": sorted(self.audio_codecs),
+            "max_height": self.max_height,
+            "max_bitrate": self.max_bitrate,
+            "max_audio_channels": self.max_audio_channels,
+            "transcode_resolution": self.transcode_resolution,
+            "multiple_parts": self.multiple_parts,
+        }
+
+    def replace(self, **changes):
+        """ A copy of this profile with some settings changed """
+        d = self.to_dict()
+        d.update(changes)
+        return self.from_dict(d)
+
+    @property
+    def key(self):
+        """ Identifies the profile's settings, for caching decisions """
+        d = self.to_dict()
+        return tuple((k, tuple(v) if isinstance(v, list) else v) for k, v in sorted(d.items()))
+
+    def problems(self, media):
+        """ Why the media's streams can't be decoded as they are, an empty list if they can """
+        problems = []
+        if media.video_codec and media.video_codec not in self.video_codecs:
+            problems.append("video codec %s" % media.video_codec)
+        if media.audio_codec and media.audio_codec not in self.audio_codecs:
+            problems.append("audio codec %s" % media.audio_codec)
+        if self.max_height is not None and (media.video_height or 0) > self.max_height:
+            problems.append("height %d" % media.video_height)
+        if self.max_bitrate is not None and (media.video_bitrate or 0) > self.max_bitrate:
+            problems.append("bitrate %d" % media.video_bitrate)
+        if self.max_audio_channels is not None and (media.audio_channels or 0) > self.max_audio_channels:
+            problems.append("%d audio channels" % media.audio_channels)
+        return problems
+
+    def profile_extra(self):
+        """ The profile in the server's X-Plex-Client-Profile-Extra syntax """
+        extra = ["add-direct-play-profile(type=videoProfile&container=%s&videoCodec=%s&audioCodec=%s)" % (
+            ",".join(sorted(self.containers)), ",".join(sorted(self.video_codecs)),
+            ",".join(sorted(self.audio_codecs)))]
+        limits = (("video.height", self.max_height), ("video.bitrate", self.max_bitrate))
+        for name, value in limits:
+            if value is not None:
+                extra.append("add-limitation(scope=videoCodec&scopeName=*&type=upperBound&name=%s&value=%d)"
+                             % (name, value))
+        if self.max_audio_channels is not None:
+            extra.append("add-limitation(scope=audioCodec&scopeName=*&type=upperBound&name=audio.channels"
+                         "&value=%d)" % self.max_audio_channels)
+        return "+".join(extra)
+
+    def __repr__(self):
+        return "<ClientProfile %s>" % self.name
+
+
+VLC = ClientProfile(
+    "vlc",
+    containers=("mkv", "mp4", "m4v", "mov", "avi", "mpegts", "ts", "webm", "wmv", "asf", "flv", "ogg", "mpeg"),
+    video_codecs=("h264", "hevc", "mpeg4", "mpeg2video", "mpeg1video", "vc1", "wmv3", "vp8", "vp9", "av1", "msmpeg4",
+                  "msmpeg4v3", "h263", "theora"),
+    audio_codecs=("aac", "ac3", "eac3", "dca", "dts", "mp3", "mp2", "flac", "alac", "truehd", "opus", "vorbis",
+                  "pcm", "wmav2", "wmapro"),
+    multiple_parts=False,
+)
+
+
+class Candidate:
+    """ One way of playing a video, see DecisionEngine.rank() """
+    __slots__ = ("kind", "media", "part", "problems", "partial", "forced", "confirmed", "reason")
+
+    def __init__(self, kind, media, part, problems=(), partial=False, reason=None):
+        self.kind = kind
+        self.media = media
+        self.part = part
+        self.problems = list(problems)
+        # Only one of several parts would be played
+        self.partial = partial
+        # A transcode was asked for, the server must not copy any streams either
+        self.forced = False
+        # Set once the server has been asked, reason is its explanation
+        self.confirmed = False
+        self.reason = reason
+
+    @property
+    def direct(self):
+        return self.kind == DIRECT_PLAY
+
+    def options(self, profile):
+        """ Transcode session options for this candidate, see TranscodeManager.create() """
+        options = {"mediaIndex": self.media.index, "partIndex": self.part.index,
+                   "directPlay": 0, "directStream": 0 if self.forced else 1}
+        if self.kind == TRANSCODE and profile.transcode_resolution is not None:
+            options["videoResolution"] = profile.transcode_resolution
+        if profile.max_bitrate is not None:
+            options["maxVideoBitrate"] = profile.max_bitrate
+        return options
+
+    def __repr__(self):
+        return "<Candidate %s media %s part %d%s%s>" % (self.kind, self.media.id, self.part.index,
+                                                        " of several" if self.partial else "",
+                                                        " (%s)" % ", ".join(self.problems) if self.problems else "")
+
+
+class DecisionEngine:
+    """
+    Ranks the formats of a video for a ClientProfile
+
+    Every format yields the best way of playing it: direct play if the player handles the container
+    and streams, direct stream if it only lacks the container, a transcode otherwise. Direct play
+    ranks before direct stream before transcode; within each, higher resolution and bitrate win.
+    Formats split into several parts rank last unless the profile handles multiple parts.
+
+    With confirm, the server's universal transcode decision is asked for the top candidate and
+    overrides the local verdict. Server decisions are cached per media id and profile. A server that
+    doesn't answer within deadline seconds is ignored and the local verdict stands.
+    """
+
+    def __init__(self, connection, profile=VLC, confirm=False, cache_size=256, deadline=2.0):
+        self.connection = connection
+        self.profile = profile
+        self.confirm = confirm
+        self.cache_size = cache_size
+        self.deadline = deadline
+
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    # Local decision
+    def candidate(self, media, profile=None):
+        profile = profile or self.profile
+        parts = media.get_parts()
+        if not parts:
+            return None
+        part = parts[0]
+
+        problems = profile.problems(media)
+        partial = len(parts) > 1 and not profile.multiple_parts
+        if problems:
+            return Candidate(TRANSCODE, media, part, problems, partial)
+        if media.container not in profile.containers:
+            return Candidate(DIRECT_STREAM, media, part, ["container %s" % media.container], partial)
+        return Candidate(DIRECT_PLAY, media, part, (), partial)
+
+    @staticmethod
+    def _sort_key(candidate):
+        media = candidate.media
+        return (candidate.partial, KINDS.index(candidate.kind), -(media.video_height or 0),
+                -(media.video_bitrate or 0), media.index)
+
+    def rank(self, video, profile=None, direct_play=True, direct_stream=True):
+        """
+        All candidates for a video, best first
+
+        direct_play and direct_stream can be set to False to force the server to do more work.
+        """
+        profile = profile or self.profile
+        candidates = []
+        for media in video.get_formats():
+            candidate = self.candidate(media, profile)
+            if candidate is None:
+                continue
+            if candidate.kind == DIRECT_PLAY and not direct_play:
+                candidate.kind = DIRECT_STREAM if direct_stream else TRANSCODE
+            elif candidate.kind == DIRECT_STREAM and not direct_stream:
+                candidate.kind = TRANSCODE
+            candidate.forced = not direct_stream
+            candidates.append(candidate)
+        candidates.sort(key=self._sort_key)
+
+        if self.confirm:
+            candidates = self._confirm(video, candidates, profile)
+        return candidates
+
+    def choose(self, video, profile=None, **kwargs):
+        """ The best candidate, or None if the video has no playable format """
+        candidates = self.rank(video, profile, **kwargs)
+        return candidates[0] if candidates else None
+
+    # Server decision
+    def _confirm(self, video, candidates, profile):
+        # Ask about the top candidate until the server agrees that it is still on top
+        for _ in range(len(candidates)):
+            top = candidates[0]
+            if top.confirmed or top.kind == TRANSCODE:
+                break
+            try:
+                kind, reason = self.server_decision(video, top, profile)
+            except Exception as e:
+                logger.warning("Could not get a playback decision from the server: %s" % e)
+                break
+            top.confirmed = True
+            top.reason = reason
+            if kind is None or KINDS.index(kind) <= KINDS.index(top.kind):
+                break
+            logger.info("Server says %s instead of %s for media %s: %s" % (kind, top.kind, top.media.id, reason))
+            top.kind = kind
+            candidates.sort(key=self._sort_key)
+        return candidates
+
+    def server_decision(self, video, candidate, profile=None):
+        """ Ask the server how it would play a candidate, returns (kind or None, reason) """
+        profile = profile or self.profile
+        key = (candidate.media.id, candidate.part.index, profile.key)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        params = {"path": "http://127.0.0.1:32400%s" % video.path,
+                  "protocol": "hls",
+                  "hasMDE": 1,
+                  "X-Plex-Client-Profile-Extra": profile.profile_extra()}
+        params.update(candidate.options(profile))
+        params["directPlay"] = 1
+        root = self.connection.xml("/video/:/transcode/universal/decision", params=params,
+                                   deadline=self.deadline).getroot()
+        decision = parse_decision(root)
+
+        with self._lock:
+            self._cache[key] = decision
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return decision
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+def parse_decision(root):
+    """ (kind or None, reason) from a decision MediaContainer, kind is None if the server can't play it """
+    if int(root.get("directPlayDecisionCode", 0)) == DECISION_OK:
+        return DIRECT_PLAY, root.get("directPlayDecisionText")
+    general = int(root.get("generalDecisionCode", DECISION_OK))
+    reason = root.get("transcodeDecisionText") or root.get("generalDecisionText")
+    if general // 1000 != DECISION_OK // 1000:
+        return None, reason
+    if any(stream.get("decision") == "transcode" for stream in root.iter("Stream")):
+        return TRANSCODE, reason
+    return DIRECT_STREAM, reason
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# GDM (G'Day Mate) LAN server discovery
+#
+# Servers answer an M-SEARCH datagram, sent to the GDM multicast group or broadcast,
+# with a HTTP-style header block naming their machineIdentifier and port.
+
+import time
+import socket
+import select
+import logging
+import concurrent.futures
+
+try:
+    from lxml import etree
+except ImportError:
+    from xml.etree import ElementTree as etree
+
+from .connection import Connection, ConnectionError
+
+logger = logging.getLogger("comPlex.discovery")
+
+GDM_MULTICAST = "239.0.0.250"
+GDM_PORT = 32414
+GDM_BROADCAST_PORTS = (32410, 32412, 32413, 32414)
+
+SEARCH = b"M-SEARCH * HTTP/1.1\r\n\r\n"
+
+
+def default_targets():
+    return [(GDM_MULTICAST, GDM_PORT)] + [("255.255.255.255", port) for port in GDM_BROADCAST_PORTS]
+
+
+class GDMResponse:
+    """
+    A server's answer to an M-SEARCH
+
+    headers are keyed by lowercase name, host is the address the answer came from.
+    """
+    __slots__ = ("host", "headers", "time")
+
+    def __init__(self, host, headers, time):
+        self.host = host
+        self.headers = headers
+        self.time = time
+
+    @classmethod
+    def parse(cls, data, host, time=None):
+        """ Parse a datagram, returns None if it is not a positive answer """
+        lines = data.decode("utf-8", "replace").splitlines()
+        if not lines or " 200 " not in lines[0] + " ":
+            return None
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        return cls(host, headers, time)
+
+    @property
+    def uuid(self):
+        return self.headers.get("resource-identifier")
+
+    @property
+    def name(self):
+        return self.headers.get("name")
+
+    @property
+    def port(self):
+        try:
+            return int(self.headers.get("port", 32400))
+        except ValueError:
+            return 32400
+
+    @property
+    def content_type(self):
+        return self.headers.get("content-type")
+
+    def is_server(self):
+        return self.uuid is not None and self.content_type in (None, "plex/media-server")
+
+    def __repr__(self):
+        return "<GDMResponse %s at %s:%d>" % (self.name, self.host, self.port)
+
+
+def iter_search(timeout=1.0, targets=None):
+    """
+    Send an M-SEARCH to all targets and yield the answers until timeout seconds have passed
+
+    targets defaults to the GDM multicast group and broadcast ports. Yields the GDMResponses
+    of media servers, one per server and address, as they arrive.
+    """
+    if targets is None:
+        targets = default_targets()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        sock.setblocking(False)
+
+        start = time.monotonic()
+        deadline = start + timeout
+
+        sent = 0
+        for target in targets:
+            try:
+                sock.sendto(SEARCH, target)
+                sent += 1
+            except OSError as e:
+                logger.debug("Could not send M-SEARCH to %s:%d: %s" % (target[0], target[1], e))
+        if not sent:
+            logger.warning("GDM discovery failed: no M-SEARCH could be sent")
+            return
+
+        seen = set()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                break
+            try:
+                data, address = sock.recvfrom(4096)
+            except OSError:
+                continue
+
+            response = GDMResponse.parse(data, address[0], time.monotonic() - start)
+            if response is None or not response.is_server():
+                continue
+            if (response.uuid, response.host, response.port) in seen:
+                continue
+            seen.add((response.uuid, response.host, response.port))
+            yield response
+    finally:
+        sock.close()
+
+
+def search(timeout=1.0, targets=None):
+    """ Collect the answers of iter_search() into a list """
+    return list(iter_search(timeout, targets))
+
+
+def probe(connection, timeout=2.0):
+    """
+    Fetch the root container of a server, identifying it and measuring the round trip
+
+    Returns the connection, or None if the server did not answer properly.
+    """
+    start = time.monotonic()
+    try:
+        response = connection._request("GET", "/", deadline=timeout)
+        root = etree.fromstring(response.content)
+    except (ConnectionError, SyntaxError) as e:
+        logger.debug("Probe of %s:%d failed: %s" % (connection.host, connection.port, e))
+        return None
+
+    connection.latency = time.monotonic() - start
+    connection.identify(root)
+    return connection
+
+
+def discover(client, timeout=1.0, probe_timeout=2.0, targets=None, **kwargs):
+    """
+    Find media servers on the local network
+
+    Responders are probed in parallel as their answers arrive. Returns ready Connections,
+    one per server using its fastest address, ordered by latency. Further addresses of a server
+    are added as alternative routes.
+    Additional keyword arguments are passed to the Connection constructor.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = []
+        for response in iter_search(timeout, targets):
+            conn = Connection(client, uuid=response.uuid, name=response.name, host=response.host,
+                              port=response.port, discovery="discovery", **kwargs)
+            futures.append(executor.submit(probe, conn, probe_timeout))
+        probed = [future.result() for future in futures]
+
+    by_server = {}
+    for conn in filter(None, probed):
+        by_server.setdefault(conn.uuid, []).append(conn)
+
+    servers = []
+    for conns in by_server.values():
+        conns.sort(key=lambda conn: conn.latency)
+        best = conns[0]
+        # Keep the other addresses for failover
+        for conn in conns[1:]:
+            best.add_address(conn.host, conn.port)
+        for conn, route in zip(conns, best.router.routes):
+            route.latency = conn.latency
+        servers.append(best)
+
+    return sorted(servers, key=lambda conn: conn.latency)
+
+
+if __name__ == "__main__":
+    from .client import Client
+
+    logging.basicConfig(level=logging.INFO)
+
+    for conn in discover(Client()):
+        print("%s\t%s:%d\t%.1f ms" % (conn.name, conn.host, conn.port, conn.latency * 1000))
@@ -19,6 +19,66 @@ class TF_Meta(type):
         if "transform" not in cls.__dict__:
             cls.transform = {}
 
+    GETTER = """
+def __get__(self, owner, _=None):
+    if owner is None:
+        return self
+%(memo_get)s
+    value = %(lookup)s
+    if value is missing:
+        value = fallback
+    else:
+        value = %(convert)s
+%(memo_set)s
+    return value
+"""
+
+    MEMO_GET = """
+    memo = owner.__dict__
+    value = memo.get(key, missing)
+    if value is not missing:
+        return value
+"""
+
+    MEMO_SET = """
+    memo[key] = value
+"""
+
+    def specialize(cls, attrib):
+        """
+        Create a subclass of cls whose __get__ is generated specifically for attrib
+
+        The lookup expression, conversion and fallback are resolved once, and if the class
+        has a memo, converted values are kept in the owning object's __dict__
+        under the attribute's name, where the data descriptor shadows them.
+        Note that this means transforms have to be registered before the owning class is created.
+        """
+        if attrib.type is None:
+            convert = None
+        elif attrib.type in cls.transform:
+            convert = cls.transform[attrib.type][0]
+        else:
+            convert = attrib.type
+
+        namespace = {
+            "attrib": attrib,
+            "name": getattr(attrib, "name", None),
+            "key": attrib.attr_name,
+            "fallback": attrib.fallback,
+            "convert": convert,
+            "missing": object(),
+        }
+        source = cls.GETTER % {
+            "lookup": cls.lookup,
+            "convert": "value" if convert is None else "convert(value)",
+            "memo_get": cls.MEMO_GET if cls.memo else "",
+            "memo_set": cls.MEMO_SET if cls.memo else "",
+        }
+        exec(compile(source, "<%s %s>" % (cls.__name__, attrib.attr_name), "exec"), namespace)
+
+        return type(cls)(cls.__name__, (cls,), {"__get__": namespace["__get__"], "transform": cls.transform,
+                                                "__module__": cls.__module__})
+
 
 class AbstractTransformAttrib(metaclass=TF_Meta):
     def __transform_get(self, value):
@@ -48,6 +108,16 @@ class AbstractTransformAttrib(metaclass=TF_Meta):
             self.transform_get = self.__transform_get
             self.transform_set = self.__transform_set
 
+    # How specialized getters find the raw value and whether they memoize, see TF_Meta.specialize
+    lookup = "attrib.get(owner, missing)"
+    memo = False
+    attr_name = None
+
+    def __set_name__(self, owner_class, name):
+        # Called when the owning class is created: switch to the specialized getter
+        self.attr_name = name
+        self.__class__ = type(self).specialize(self)
+
     def __get__(self, owner, _=None, *, _fallback=object()):
         if owner is None:
             return self
@@ -56,12 +126,16 @@ class AbstractTransformAttrib(metaclass=TF_Meta):
 
     def __set__(self, owner, value):
         self.set(owner, self.transform_set(value))
+        if self.memo:
+            owner.__dict__.pop(self.attr_name, None)
 
         # abstract def get(self, owner, fallback)
         # abstract def set(self, owner, value)
 
 
 class TransformAttrib(AbstractTransformAttrib):
+    lookup = "getattr(owner, name, missing)"
+
     def __init__(self, name, type=None, fallback=None):
         super().__init__(type, fallback)
         self.name = name
@@ -81,6 +155,9 @@ class XmlObject(ConnectedObject):
 
 
 class XmlAttrib(AbstractTransformAttrib):
+    lookup = "owner.xml.get(name, missing)"
+    memo = True
+
     def __init__(self, name, fallback=None, type=None):
         super().__init__(type, fallback)
         self.name = name
@@ -103,6 +180,8 @@ class OperationObject(ConnectedObject):
 
 
 class OptionAttrib(AbstractTransformAttrib):
+    lookup = "owner.options.get(name, missing)"
+
     def __init__(self, name, type=None, fallback=None):
         super().__init__(type, fallback)
         self.name = name
@@ -8,17 +8,27 @@
 
 import os
 import sys
+import signal
+import socket
 import logging
-import time
 import uuid
+import threading
+import concurrent.futures
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 
-from .library import BaseContainer, Video, Container
+from .library import BaseContainer, Video, Container, create_item
 from .connection import Connection, ConnectionError
 from .client import Client
-from .transcode import TranscodeSession
-from . import __version__
+from .store import MetadataStore
+from .search import SearchIndex
+from .thumbcache import ThumbnailCache, ThumbnailKey
+from .transcode import TranscodeManager
+from .hls import HLSProxy
+from .decision import DecisionEngine, VLC
+from .timeline import TimelineReporter, PLAYING, PAUSED
+from .mutations import MutationQueue
+from . import discovery, __version__
 
 CACHE_PATH = "/tmp/comPlex"  # TODO: globals are bad
 
@@ -38,47 +48,13 @@ class Item:
 
 
 class ChildItem(Item):
-    KeepImageInMemory = False
-
     def __init__(self, data, parent=None, row=0):
         super().__init__(data, parent, row)
         self.conn = data.connection
 
-        if data.thumbnail_path:
-            self.ifile = os.path.join(CACHE_PATH, self.conn.name, data.thumbnail_path.replace("/", "+"))
-        else:
-            self.ifile = None
-
-        self._image = None
-
     def title(self):
         return self.data.title
 
-    def image(self):
-        if self._image is not None:
-            return self._image
-        elif not self.ifile:
-            return None
-        elif os.path.isfile(self.ifile):
-            img = QtGui.QPixmap(self.ifile)
-        else:
-            try:
-                res = self.conn._request("GET", self.data.thumbnail_path)
-            except ConnectionError:
-                return
-            else:
-                with open(self.ifile, "wb") as f:
-                    f.write(res.content)
-                img = QtGui.QPixmap.fromImage(QtGui.QImage.fromData(res.content))
-
-        # Scale
-        image = img.scaledToHeight(100)
-
-        if self.KeepImageInMemory:
-            self._image = image
-
-        return image
-
     tooltip = title
 
     def __eq__(self, other):
@@ -101,14 +77,27 @@ class ServerItem(Item):
     def has_children(self):
         return True
 
+    def can_fetch_more(self):
+        return False
+
     def title(self):
         return self.data.name
 
 
 class ContainerItem(ChildItem):
+    def __init__(self, data, parent=None, row=0):
+        super().__init__(data, parent, row)
+        # Children are loaded incrementally through fetch_page()
+        self.loaded = []
+        # Start of the next page, and the elements fetched so far for the store
+        self.offset = 0
+        self.collected = []
+        self.exhausted = False
+        self.fetching = False
+
     def get_child(self, row):
         if row not in self.children:
-            it = self.data[row]
+            it = self.loaded[row]
             if isinstance(it, BaseContainer):
                 ci = ContainerItem(it, self, row)
             else:
@@ -117,7 +106,22 @@ class ContainerItem(ChildItem):
         return self.children[row]
 
     def size(self):
-        return sum(1 for x in self.data.children_xml.iterchildren("Directory", "Video"))
+        return len(self.loaded)
+
+    def can_fetch_more(self):
+        return not self.exhausted
+
+    def fetch_page(self):
+        """
+        Fetch the next page of children, may be called from a worker thread
+
+        Returns the new children and whether they were the last ones.
+        """
+        children, self.offset = self.conn.children_page(self.data.children_xml_path, self.offset,
+                                                        self.data.updated_at, collected=self.collected)
+        if self.offset is None:
+            self.collected = []
+        return [create_item(self.conn, xml) for xml in children], self.offset is None
 
     def has_children(self):
         return self.data.size is None or self.data.size > 0
@@ -145,6 +149,9 @@ class FileItem(ChildItem):
     def has_children(self):
         return False
 
+    def can_fetch_more(self):
+        return False
+
     def get_child(self, row):
         return None
 
@@ -152,10 +159,181 @@ class FileItem(ChildItem):
         return self.data.views == 0
 
 
+class ThumbnailLoader(QtCore.QObject):
+    """
+    Fetches and decodes thumbnails on a thread pool
+
+    request() returns the cached pixmap or a placeholder right away; ready is emitted for every item
+    waiting on a thumbnail once it has been loaded. Concurrent requests for the same thumbnail are merged.
+    """
+    ready = QtCore.pyqtSignal(object)
+    _loaded = QtCore.pyqtSignal(object, QtGui.QImage)
+
+    KeepInMemory = 64 << 20
+    KeepInMemoryMin = 8 << 20
+
+    def __init__(self, cache, height=100, workers=4, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.height = height
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.pending = {}
+        self._placeholders = {}
+
+        # Emitted from the workers, delivered in the GUI thread
+        self._loaded.connect(self._onLoaded, QtCore.Qt.QueuedConnection)
+
+    def placeholder(self, height):
+        if height not in self._placeholders:
+            pixmap = QtGui.QPixmap(height * 2 // 3, height)
+            pixmap.fill(QtCore.Qt.transparent)
+            self._placeholders[height] = pixmap
+        return self._placeholders[height]
+
+    def setHeight(self, height):
+        if height != self.height:
+            self.height = height
+            self.cancel()
+
+    def request(self, item):
+        if not item.data.thumbnail_path:
+            return None
+
+        key = ThumbnailKey(item.conn.uuid or item.conn.name, item.data.thumbnail_path, self.height)
+
+        pixmap = self.cache.get_image(key)
+        if pixmap is not None:
+            return pixmap
+
+        if key in self.pending:
+            items = self.pending[key][1]
+            if not any(waiting is item for waiting in items):
+                items.append(item)
+        else:
+            future = self.executor.submit(self._load, item.conn, item.data.thumbnail_path, key, self.height)
+            self.pending[key] = future, [item]
+
+        return self.placeholder(self.height)
+
+    def cancel(self, keep=lambda item: False):
+        """
+        Cancel pending requests unless keep() returns True for one of the waiting items
+        """
+        for key, (future, items) in list(self.pending.items()):
+            items = [item for item in items if keep(item)]
+            if not items and future.cancel():
+                del self.pending[key]
+            else:
+                # Running requests finish, but only notify items that still care
+                self.pending[key] = future, items
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+    # Worker thread
+    def _load(self, conn, path, key, height):
+        # Always report back, or the key stays pending and the thumbnail is never requested again
+        image = QtGui.QImage()
+        try:
+            image = self._read(conn, path, key, height)
+        except ConnectionError:
+            pass
+        except Exception:
+            logging.exception("Could not load thumbnail %s" % path)
+        finally:
+            self._loaded.emit(key, image)
+
+    def _read(self, conn, path, key, height):
+        data = self.cache.get_data(key)
+        if data is None:
+            # Let the server scale it, the height is what matters
+            data = conn.get_photo(path, height * 2, height)
+            try:
+                self.cache.put_data(key, data)
+            except OSError as e:
+                # Still show it, it just isn't kept on disk
+                logging.warning("Could not store thumbnail %s: %s" % (path, e))
+
+        # Decode straight to the target size
+        buffer = QtCore.QBuffer()
+        buffer.setData(data)
+        reader = QtGui.QImageReader(buffer)
+        size = reader.size()
+        if size.isValid() and size.height() > 0:
+            reader.setScaledSize(QtCore.QSize(max(1, size.width() * height // size.height()), height))
+        return reader.read()
+
+    # GUI thread
+    def _onLoaded(self, key, image):
+        _, items = self.pending.pop(key, (None, ()))
+        if image.isNull():
+            return
+
+        pixmap = QtGui.QPixmap.fromImage(image)
+        self.cache.put_image(key, pixmap, image.byteCount())
+
+        for item in items:
+            self.ready.emit(item)
+
+
 class PlexModel(QtCore.QAbstractItemModel):
-    def __init__(self, root, parent=None):
+    _fetched = QtCore.pyqtSignal(object, object, bool)
+
+    def __init__(self, root, thumbnails, parent=None):
         super().__init__(parent)
         self.root = root
+        self.thumbnails = thumbnails
+        self.thumbnails.ready.connect(self.thumbnailReady)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(2)
+        self._fetched.connect(self._onFetched, QtCore.Qt.QueuedConnection)
+
+    def itemIndex(self, item):
+        if item is self.root:
+            return QtCore.QModelIndex()
+        return self.createIndex(item.row, 0, item)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        item = parent.internalPointer() if parent.isValid() else self.root
+        return item.can_fetch_more()
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        item = parent.internalPointer() if parent.isValid() else self.root
+        if not item.can_fetch_more() or item.fetching:
+            return
+        item.fetching = True
+        self.executor.submit(self._fetch, item)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    # Worker thread
+    def _fetch(self, item):
+        # Always report back, or the item stays marked as fetching
+        items, exhausted = [], True
+        try:
+            items, exhausted = item.fetch_page()
+        except ConnectionError as e:
+            logging.error("Could not load '%s': %s" % (item.title(), e))
+        except Exception:
+            logging.exception("Could not load '%s'" % item.title())
+        finally:
+            self._fetched.emit(item, items, exhausted)
+
+    # GUI thread
+    def _onFetched(self, item, items, exhausted):
+        if items:
+            first = len(item.loaded)
+            self.beginInsertRows(self.itemIndex(item), first, first + len(items) - 1)
+            item.loaded.extend(items)
+            self.endInsertRows()
+        item.exhausted = exhausted
+        item.fetching = False
+
+    def thumbnailReady(self, item):
+        ix = self.createIndex(item.row, 0, item)
+        self.dataChanged.emit(ix, ix, [QtCore.Qt.DecorationRole])
 
     def index(self, row, column, parent=QtCore.QModelIndex()):
         if not self.hasIndex(row, column, parent):
@@ -204,7 +382,7 @@ class PlexModel(QtCore.QAbstractItemModel):
                 elif role == QtCore.Qt.ToolTipRole:
                     return ip.tooltip()
                 elif role == QtCore.Qt.DecorationRole:
-                    return ip.image()
+                    return self.thumbnails.request(ip)
 
 
 class FlatProxy(QtCore.QAbstractProxyModel):
@@ -213,6 +391,30 @@ class FlatProxy(QtCore.QAbstractProxyModel):
 
         self.parent_index = QtCore.QModelIndex()
 
+    def setSourceModel(self, model):
+        super().setSourceModel(model)
+        model.dataChanged.connect(self.sourceDataChanged)
+        model.rowsAboutToBeInserted.connect(self.sourceRowsAboutToBeInserted)
+        model.rowsInserted.connect(self.sourceRowsInserted)
+
+    def sourceDataChanged(self, top_left, bottom_right, roles=()):
+        if top_left.parent() == self.parent_index:
+            self.dataChanged.emit(self.mapFromSource(top_left), self.mapFromSource(bottom_right), roles)
+
+    def sourceRowsAboutToBeInserted(self, parent, first, last):
+        if parent == self.parent_index:
+            self.beginInsertRows(QtCore.QModelIndex(), first, last)
+
+    def sourceRowsInserted(self, parent, first, last):
+        if parent == self.parent_index:
+            self.endInsertRows()
+
+    def canFetchMore(self, parent=None):
+        return self.sourceModel().canFetchMore(self.parent_index)
+
+    def fetchMore(self, parent=None):
+        self.sourceModel().fetchMore(self.parent_index)
+
     def setParentIndex(self, ix):
         self.modelAboutToBeReset.emit()
         self.parent_index = ix
@@ -237,17 +439,57 @@ class FlatProxy(QtCore.QAbstractProxyModel):
         return QtCore.QModelIndex()
 
 
+class SearchModel(QtCore.QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.hits = []
+
+    def setHits(self, hits):
+        self.beginResetModel()
+        self.hits = hits
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.hits)
+
+    def data(self, index: QtCore.QModelIndex, role=QtCore.Qt.DisplayRole):
+        hit = self.hits[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return hit.title
+        elif role == QtCore.Qt.ToolTipRole:
+            return "%s (%s)" % (hit.title, hit.type)
+
+
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, conn, parent=None):
+    # Thumbnail height per view mode
+    ThumbnailHeights = {"icons": 100, "list": 32, "tree": 32}
+
+    # video, profile, candidate; the decision is made on a worker thread
+    _playbackDecided = QtCore.pyqtSignal(object, object, object)
+
+    def __init__(self, conn, thumbnails, parent=None):
         super().__init__(parent)
 
         self.conn = conn
 
-        self.model = PlexModel(ServerItem(conn), self)
+        self.thumbnails = ThumbnailLoader(thumbnails, self.ThumbnailHeights["icons"], parent=self)
+        self.model = PlexModel(ServerItem(conn), self.thumbnails, self)
         self.flat_model = FlatProxy(self)
         self.flat_model.setSourceModel(self.model)
 
         self.force_transcode = False
+        self.transcodes = TranscodeManager(conn)
+        self.decisions = DecisionEngine(conn, VLC, confirm=True)
+        self._playbackDecided.connect(self.startPlayback, QtCore.Qt.QueuedConnection)
+        self.timeline = TimelineReporter(conn)
+        threading.Thread(target=self.killOrphanedTranscodes, daemon=True).start()
+
+        # Search everything that was browsed or stored before
+        self.search_index = SearchIndex()
+        self.search_index.attach(conn)
+        self.search_model = SearchModel(self)
+        if conn.store is not None:
+            threading.Thread(target=self.seedSearchIndex, daemon=True).start()
 
         self.setupUi()
 
@@ -290,6 +532,8 @@ class MainWindow(QtWidgets.QMainWindow):
         keep_thumbs.setCheckable(True)
         keep_thumbs.toggled.connect(self.toggleKeepThumbs)
         keep_thumbs.setChecked(settings.value("KeepThumbnailsInMemory", False, type=bool))
+        self.thumbnails.cache.set_max_memory(ThumbnailLoader.KeepInMemory if keep_thumbs.isChecked()
+                                             else ThumbnailLoader.KeepInMemoryMin)
 
         # Stacked widget
         # TODO: be smarter about it and convert between views
@@ -297,10 +541,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.setCentralWidget(self.stack)
 
         # Tree View
-        view = QtWidgets.QTreeView(self)
-        view.setModel(self.model)
-        view.activated.connect(self.absItemActivated)
-        self.stack.addWidget(view)
+        self.tree = QtWidgets.QTreeView(self)
+        self.tree.setModel(self.model)
+        self.tree.setIconSize(QtCore.QSize(self.ThumbnailHeights["tree"], self.ThumbnailHeights["tree"]))
+        self.tree.activated.connect(self.absItemActivated)
+        self.stack.addWidget(self.tree)
 
         # Flat View
         widget = QtWidgets.QWidget(self)
@@ -314,11 +559,42 @@ class MainWindow(QtWidgets.QMainWindow):
         self.list = QtWidgets.QListView(self)
         self.list.setGridSize(QtCore.QSize(110, 120))
         self.list.setWordWrap(True)
+        self.list.setUniformItemSizes(True)
         self.list.setModel(self.flat_model)
         self.list.activated.connect(self.relItemActivated)
         grid.addWidget(self.list, 1, 0, 1, 4)
+
+        # Drop thumbnail requests for items that scrolled out of view
+        self.cancel_timer = QtCore.QTimer(self)
+        self.cancel_timer.setSingleShot(True)
+        self.cancel_timer.setInterval(100)
+        self.cancel_timer.timeout.connect(self.cancelInvisibleThumbs)
+        self.list.verticalScrollBar().valueChanged.connect(self.cancel_timer.start)
+        self.list.horizontalScrollBar().valueChanged.connect(self.cancel_timer.start)
+        self.tree.verticalScrollBar().valueChanged.connect(self.cancel_timer.start)
+        self.tree.horizontalScrollBar().valueChanged.connect(self.cancel_timer.start)
+        self.tree.collapsed.connect(self.cancel_timer.start)
+        self.stack.currentChanged.connect(self.cancel_timer.start)
         self.stack.addWidget(widget)
 
+        # Search
+        self.search_results = QtWidgets.QListView(self)
+        self.search_results.setUniformItemSizes(True)
+        self.search_results.setModel(self.search_model)
+        self.search_results.activated.connect(self.searchItemActivated)
+        self.stack.addWidget(self.search_results)
+
+        self.search = QtWidgets.QLineEdit(self)
+        self.search.setPlaceholderText("Search")
+        self.search.setClearButtonEnabled(True)
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.runSearch)
+        self.search.textChanged.connect(self.search_timer.start)
+        self.search.returnPressed.connect(self.runSearch)
+        self.addToolBar("Search").addWidget(self.search)
+
         icons.setChecked(True)
         self.setViewIcons()
 
@@ -331,26 +607,81 @@ class MainWindow(QtWidgets.QMainWindow):
             self.setViewTree()
 
         # Status Bar
-        self.statusBar().showMessage("Connected to %s" % conn.name)
+        self.statusBar().showMessage("Connected to %s" % self.conn.name)
 
         settings.endGroup()
 
+    def closeEvent(self, event):
+        self.transcodes.close()
+        self.timeline.close()
+        if self.conn.mutations is not None:
+            self.conn.mutations.close()
+        self.model.shutdown()
+        self.thumbnails.shutdown()
+        super().closeEvent(event)
+
     def refresh(self):
         QtWidgets.QMessageBox.critical(self, "Not Implemented",
                                        "Refreshing not supported at this time. Restart the software")
 
+    def setThumbnailHeight(self, mode):
+        height = self.ThumbnailHeights[mode]
+        self.thumbnails.setHeight(height)
+        self.list.setIconSize(QtCore.QSize(height, height))
+        self.list.viewport().update()
+        self.tree.viewport().update()
+
+    def killOrphanedTranscodes(self):
+        # Left behind by an earlier run that didn't exit cleanly
+        try:
+            self.transcodes.kill_orphans()
+        except ConnectionError as e:
+            logging.warning("Could not check for orphaned transcode sessions: %s" % e)
+
+    def seedSearchIndex(self):
+        for xml in self.conn.store.iter_items(self.conn.uuid):
+            self.search_index.add_xml(self.conn, xml)
+
+    def runSearch(self):
+        self.search_timer.stop()
+        query = self.search.text()
+        if query.strip():
+            self.search_model.setHits(self.search_index.search(query, 200))
+            self.stack.setCurrentIndex(2)
+        else:
+            self.search_model.setHits([])
+            self.stack.setCurrentIndex(self.view_index)
+
+    def searchItemActivated(self, ix):
+        hit = self.search_model.hits[ix.row()]
+        try:
+            item = hit.get_item()
+        except ConnectionError as e:
+            self.statusBar().showMessage("Could not load %s: %s" % (hit.title, e))
+            return
+        if isinstance(item, Video):
+            self.playVideo(item)
+        else:
+            self.statusBar().showMessage("%s is not playable" % hit.title)
+
     def setViewIcons(self):
+        self.view_index = 1
         self.stack.setCurrentIndex(1)
         self.list.setViewMode(QtWidgets.QListView.IconMode)
+        self.setThumbnailHeight("icons")
         self.setSetting("GUI/View", "icons")
 
     def setViewList(self):
+        self.view_index = 1
         self.stack.setCurrentIndex(1)
         self.list.setViewMode(QtWidgets.QListView.ListMode)
+        self.setThumbnailHeight("list")
         self.setSetting("GUI/View", "list")
 
     def setViewTree(self):
+        self.view_index = 0
         self.stack.setCurrentIndex(0)
+        self.setThumbnailHeight("tree")
         self.setSetting("Gui/View", "tree")
 
     def toggleForceTranscode(self, state):
@@ -358,7 +689,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.setSetting("GUI/AlwaysTranscode", state, "Always Request Transcode")
 
     def toggleKeepThumbs(self, state):
-        ChildItem.KeepImageInMemory = state
+        self.thumbnails.cache.set_max_memory(ThumbnailLoader.KeepInMemory if state else ThumbnailLoader.KeepInMemoryMin)
         self.setSetting("GUI/KeepThumbnailsInMemory", state, "Keep thumbnails in memory")
 
     def setSetting(self, key, value, description=None):
@@ -374,6 +705,24 @@ class MainWindow(QtWidgets.QMainWindow):
         if isinstance(item, Video):
             self.playVideo(item)
 
+    def isItemVisible(self, item):
+        view = self.stack.currentIndex()
+        if view == 0:
+            # Rows below a collapsed parent have no rectangle
+            rect = self.tree.visualRect(self.model.itemIndex(item))
+            return rect.isValid() and rect.intersects(self.tree.viewport().rect())
+        if view != 1:
+            # Search results have no thumbnails
+            return False
+        parent = self.flat_model.parent_index
+        if item.parent is not (parent.internalPointer() if parent.isValid() else self.model.root):
+            return False
+        rect = self.list.visualRect(self.flat_model.index(item.row, 0))
+        return rect.intersects(self.list.viewport().rect())
+
+    def cancelInvisibleThumbs(self):
+        self.thumbnails.cancel(self.isItemVisible)
+
     def relItemActivated(self, ix):
         index = self.flat_model.mapToSource(ix)
         item = index.internalPointer().data
@@ -382,6 +731,7 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             self.flat_model.setParentIndex(index)
             self.location.setText(self.location.text() + " > " + item.title)
+            self.cancelInvisibleThumbs()
 
     def relGoUp(self):
         self.flat_model.setParentIndex(self.model.parent(self.flat_model.parent_index))
@@ -389,61 +739,90 @@ class MainWindow(QtWidgets.QMainWindow):
             self.location.setText(self.conn.name)
         else:
             self.location.setText(self.location.text().rsplit(" > ", 1)[0])
+        self.cancelInvisibleThumbs()
 
     def playVideo(self, video):
-        # Figure out what to play
-        best_format = None
-        best_score = 0
-        for format in video.get_formats():
-            score = 1000
-            if format.video_height > 800:
-                score -= 100
-            elif format.video_height < 480:
-                score -= 100
-            if len(format.get_parts()) != 1:
-                score -= 1000
-            if format.container == "mkv":
-                score += 10
-            if score > best_score:
-                best_score = score
-                best_format = format
-
-        if not best_format:
+        force = self.force_transcode
+
+        # Both measuring and deciding may talk to the server
+        def decide():
+            # Measure remote links before deciding, direct play needs the whole bitrate
+            formats = video.get_formats()
+            if self.conn.bandwidth.estimate is None and not self.conn.local and formats and formats[0].get_parts():
+                try:
+                    self.conn.bandwidth.probe(self.conn, formats[0].get_parts()[0].path, deadline=5.0)
+                except ConnectionError as e:
+                    logging.warning("Bandwidth probe failed: %s" % e)
+
+            profile = self.decisions.profile.replace(max_bitrate=self.conn.bandwidth.max_bitrate(self.conn.local))
+            try:
+                candidate = self.decisions.choose(video, profile, direct_play=not force, direct_stream=not force)
+            except Exception as e:
+                logging.error("Could not decide how to play '%s': %s" % (video.title, e))
+                candidate = None
+            self._playbackDecided.emit(video, profile, candidate)
+
+        self.statusBar().showMessage("Preparing '%s'" % video.title)
+        threading.Thread(target=decide, daemon=True, name="comPlex playback decision").start()
+
+    def startPlayback(self, video, profile, candidate):
+        if not candidate:
             QtWidgets.QMessageBox.critical(None, "Cannot play Video", "no suitable format found")
             return
 
-        # Check if we need to transcode
         ts = None
-        if best_format.video_height > 750 or self.force_transcode:
-            ts = TranscodeSession.from_library(video,
-                                               protocol="http",
-                                               videoResolution="720",
-                                               fastSeek=1,
-                                               directPlay=0,
-                                               )
-            stream_url = ts.url
-            logging.info("New transcode session: %s" % ts.uuid)
+        proxy = None
+        if not candidate.direct:
+            ts = self.transcodes.create(video, "m3u8", fastSeek=1, **candidate.options(profile))
+            logging.info("New transcode session: %s (%r)" % (ts.uuid, candidate))
+            # Prefetch segments ahead of VLC, let it play the playlist directly if that fails
+            try:
+                proxy = HLSProxy.from_session(ts)
+                stream_url = proxy.url
+            except Exception as e:
+                logging.warning("Could not start HLS proxy: %s" % e)
+                stream_url = ts.url
         else:
-            stream_url = self.conn.get_url(best_format.get_parts()[0].path)
+            stream_url = self.conn.get_url(candidate.part.path)
 
         proc = QtCore.QProcess(self)
         proc.setProgram("/usr/bin/vlc")
-        proc.setArguments([stream_url, "vlc://quit"])
-
-        self.statusBar().showMessage("Watching '%s'%s" % (video.title, " (transcode)" if ts else ""))
-
-        start_time = time.time()
+        # The rc interface tells us the playback position
+        proc.setArguments(["--extraintf=rc", "--rc-fake-tty", stream_url, "vlc://quit"])
+
+        self.statusBar().showMessage("Watching '%s'%s" % (video.title, " (%s)" % candidate.kind if ts else ""))
+
+        position = 0
+        state = PLAYING
+        poll = QtCore.QTimer(proc)
+        poll.setInterval(1000)
+        # status answers with lines like "( state paused )", get_time with the seconds
+        poll.timeout.connect(lambda: proc.write(b"status\nget_time\n"))
+
+        def onOutput():
+            nonlocal position, state
+            for line in bytes(proc.readAllStandardOutput()).decode("utf-8", "replace").splitlines():
+                line = line.lstrip("> ").strip()
+                if line.isdigit():
+                    position = int(line) * 1000
+                    self.timeline.update(video, position, state)
+                elif line.startswith("( state "):
+                    state = PAUSED if line[8:].rstrip(" )") == "paused" else PLAYING
 
         def onFinished(code, status):
-            if time.time() - start_time >= video.duration / 2000:
-                video.mark_watched()
+            poll.stop()
+            self.timeline.stop(video, position)
+            if proxy is not None:
+                proxy.close()
             if ts is not None:
-                ts.stop()
+                self.transcodes.release(ts)
             self.statusBar().showMessage("Finished watching '%s'" % video.title)
 
+        proc.readyReadStandardOutput.connect(onOutput)
         proc.finished.connect(onFinished)
 
         proc.start()
+        poll.start()
 
 
 class CPGuiClient(Client):
@@ -480,6 +859,27 @@ class CPGuiClient(Client):
         self.DeviceName = device_name
 
 
+def handle_signals(app):
+    """
+    Let Python signal handlers run while Qt's event loop has control
+
+    Python only runs them once the interpreter gets to execute something, so the wakeup fd
+    is watched by a QSocketNotifier. SIGINT quits the application, which runs the atexit cleanup.
+    """
+    receiver, sender = socket.socketpair()
+    receiver.setblocking(False)
+    sender.setblocking(False)
+    signal.set_wakeup_fd(sender.fileno())
+
+    notifier = QtCore.QSocketNotifier(receiver.fileno(), QtCore.QSocketNotifier.Read, app)
+    notifier.activated.connect(lambda: receiver.recv(64))
+    # Keep the sockets alive as long as the application
+    notifier.sockets = receiver, sender
+
+    signal.signal(signal.SIGINT, lambda signum, frame: app.quit())
+    return notifier
+
+
 # noinspection PyArgumentList
 if __name__ == "__main__":
     # Setup application
@@ -490,6 +890,7 @@ if __name__ == "__main__":
     app.setOrganizationName("Orochimarufan")
     app.setApplicationName("comPlex")
     app.setApplicationVersion(__version__)
+    handle_signals(app)
 
     # Read settings
     settings = QtCore.QSettings()
@@ -497,44 +898,61 @@ if __name__ == "__main__":
     settings.beginGroup("Server")
     server_host = settings.value("Host", None)
     server_port = settings.value("Port", 32400, type=int)
+    # Alternative addresses of the server, as host:port
+    server_addresses = settings.value("Addresses", [], type=list)
 
     if server_host is None:
-        server_host, ok = QtWidgets.QInputDialog.getText(None, "comPlex server host",
-                                                         "Please enter the Plex server to connect to")
+        # Offer the servers found on the local network
+        found = {"%s:%d" % (server.host, server.port): server for server in discovery.discover(CPGuiClient())}
+
+        server_host, ok = QtWidgets.QInputDialog.getItem(None, "comPlex server host",
+                                                         "Please enter the Plex server to connect to",
+                                                         list(found), 0, True)
 
         if not ok:
             logging.error("Host input dialog aborted.")
             sys.exit(1)
 
+        if server_host in found:
+            server_addresses = ["%s:%d" % (route.host, route.port) for route in found[server_host].router.routes[1:]]
+
         if ":" in server_host:
             server_host, server_port = server_host.split(":", 1)
             server_port = int(server_port)
 
         settings.setValue("Host", server_host)
         settings.setValue("Port", server_port)
+        settings.setValue("Addresses", server_addresses)
 
     settings.endGroup()
 
-    settings.beginGroup("GUI")
-    ChildItem.KeepImageInMemory = settings.value("KeepThumbnailsInMemory", False, type=bool)
-    settings.endGroup()
-
     del settings
 
-    # Connect to server
-    conn = Connection(CPGuiClient(), host=server_host, port=server_port)
-    conn.refresh()
-
     # Setup the cache
     CACHE_PATH = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.CacheLocation)
 
-    logging.info("Cache at %s/%s", CACHE_PATH, conn.name)
+    if not os.path.isdir(CACHE_PATH):
+        os.makedirs(CACHE_PATH)
+
+    store = MetadataStore(os.path.join(CACHE_PATH, "metadata.sqlite"))
+
+    # Connect to server
+    addresses = [(host, int(port)) for host, port in (address.rsplit(":", 1) for address in server_addresses)]
+    conn = Connection(CPGuiClient(), host=server_host, port=server_port, store=store, addresses=addresses)
+    if not conn.refresh():
+        logging.warning("Server %s is offline, browsing stored metadata", conn.name)
+    # Send library changes in the background, keeping them across restarts while offline
+    conn.mutations = MutationQueue(conn, os.path.join(CACHE_PATH, "mutations.sqlite"))
+    if addresses:
+        # Follow the fastest address as the network changes
+        conn.router.monitor()
+
+    logging.info("Cache at %s", CACHE_PATH)
 
-    if not os.path.isdir(os.path.join(CACHE_PATH, conn.name)):
-        os.makedirs(os.path.join(CACHE_PATH, conn.name))
+    thumbnails = ThumbnailCache(os.path.join(CACHE_PATH, "thumbnails"))
 
     # Show window & run
-    win = MainWindow(conn)
+    win = MainWindow(conn, thumbnails)
 
     win.show()
     sys.exit(app.exec())
@@ -0,0 +1,367 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# HLS playback of transcode sessions
+#
+# The server's playlist is loaded through the Connection, the segments following
+# the player's position are prefetched into a bounded buffer and served to the
+# player from a local HTTP server.
+
+import time
+import logging
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger("comPlex.hls")
+
+
+class Segment:
+    __slots__ = ("uri", "duration", "sequence")
+
+    def __init__(self, uri, duration, sequence):
+        self.uri = uri
+        self.duration = duration
+        self.sequence = sequence
+
+    def __repr__(self):
+        return "<Segment %d %s (%.1fs)>" % (self.sequence, self.uri, self.duration)
+
+
+class Playlist:
+    """
+    A parsed m3u8 playlist
+
+    Master playlists have variants, (attributes, uri) pairs; media playlists have segments.
+    URIs are resolved against base.
+    """
+
+    def __init__(self):
+        self.variants = []
+        self.segments = []
+        self.target_duration = None
+        self.media_sequence = 0
+        self.ended = False
+
+    @property
+    def is_master(self):
+        return bool(self.variants)
+
+    @property
+    def first(self):
+        return self.media_sequence
+
+    @property
+    def last(self):
+        return self.media_sequence + len(self.segments) - 1
+
+    def segment(self, sequence):
+        index = sequence - self.media_sequence
+        return self.segments[index] if 0 <= index < len(self.segments) else None
+
+    @classmethod
+    def parse(cls, text, base=""):
+        self = cls()
+        lines = [line.strip() for line in text.splitlines()]
+        if not lines or lines[0] != "#EXTM3U":
+            raise ValueError("Not an m3u8 playlist")
+
+        duration = None
+        attributes = None
+        for line in lines[1:]:
+            if not line:
+                continue
+            elif line.startswith("#EXT-X-TARGETDURATION:"):
+                self.target_duration = float(line.partition(":")[2])
+            elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                self.media_sequence = int(line.partition(":")[2])
+            elif line.startswith("#EXTINF:"):
+                duration = float(line.partition(":")[2].partition(",")[0])
+            elif line.startswith("#EXT-X-STREAM-INF:"):
+                attributes = parse_attributes(line.partition(":")[2])
+            elif line == "#EXT-X-ENDLIST":
+                self.ended = True
+            elif line.startswith("#"):
+                continue
+            elif attributes is not None:
+                self.variants.append((attributes, urllib.parse.urljoin(base, line)))
+                attributes = None
+            else:
+                self.segments.append(Segment(urllib.parse.urljoin(base, line), duration or 0.0,
+                                             self.media_sequence + len(self.segments)))
+                duration = None
+        return self
+
+    def render(self, uri):
+        """ Write the playlist back, uri(segment) gives the URI to use for a segment """
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3",
+                 "#EXT-X-TARGETDURATION:%d" % round(self.target_duration or
+                                                    max((s.duration for s in self.segments), default=10)),
+                 "#EXT-X-MEDIA-SEQUENCE:%d" % self.media_sequence]
+        for segment in self.segments:
+            lines.append("#EXTINF:%.3f," % segment.duration)
+            lines.append(uri(segment))
+        if self.ended:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+
+def parse_attributes(text):
+    """ Parse an attribute list like BANDWIDTH=2000000,RESOLUTION=1280x720,CODECS="avc1,mp4a" """
+    attributes = {}
+    while text:
+        name, _, text = text.partition("=")
+        if text.startswith('"'):
+            value, _, text = text[1:].partition('"')
+            text = text.partition(",")[2]
+        else:
+            value, _, text = text.partition(",")
+        attributes[name.strip()] = value
+    return attributes
+
+
+def load_playlist(connection, path):
+    """
+    Load a media playlist, following a master playlist to its highest bandwidth variant
+
+    Returns the path of the media playlist and the Playlist.
+    """
+    playlist = Playlist.parse(connection._request("GET", path).text, path)
+    if playlist.is_master:
+        _, path = max(playlist.variants, key=lambda variant: int(variant[0].get("BANDWIDTH", 0)))
+        playlist = Playlist.parse(connection._request("GET", path).text, path)
+    return path, playlist
+
+
+class SegmentPrefetcher:
+    """
+    Downloads the segments ahead of the player
+
+    get(sequence) moves the play position and returns the segment's data, waiting for it if needed.
+    Up to prefetch segments after the position are downloaded by a pool of worker threads,
+    older segments are dropped from the buffer, as are the farthest ones when it exceeds max_bytes.
+    """
+
+    def __init__(self, connection, path, prefetch=4, workers=2, max_bytes=64 << 20):
+        self.connection = connection
+        self.path = path
+        self.prefetch = prefetch
+        self.max_bytes = max_bytes
+
+        self.playlist = None
+        # Set once the first playlist load finished, successfully or not
+        self.loaded = threading.Event()
+        self.error = None
+        self.position = None
+        self.buffer = {}
+        self.size = 0
+        self.errors = {}
+        self.pending = set()
+        self.closed = False
+        self._loaded = 0
+
+        self._cond = threading.Condition()
+        self._workers = [threading.Thread(target=self._work, daemon=True, name="comPlex HLS prefetch")
+                         for _ in range(workers)]
+
+    def start(self):
+        """ Load the playlist in the background and prefetch from its beginning """
+        threading.Thread(target=self._start, daemon=True, name="comPlex HLS playlist").start()
+        return self
+
+    def _start(self):
+        # The transcoder can take a while to answer start.m3u8
+        try:
+            self.reload()
+        except Exception as e:
+            logger.error("Could not load playlist %s: %s" % (self.path, e))
+            self.error = e
+            self.loaded.set()
+            return
+        with self._cond:
+            self.position = self.playlist.first
+        self.loaded.set()
+        for worker in self._workers:
+            worker.start()
+
+    def wait_loaded(self, timeout=60.0):
+        """ Wait for the first playlist, raises the loading error if there was one """
+        if not self.loaded.wait(timeout):
+            raise TimeoutError("Playlist %s not loaded" % self.path)
+        if self.error is not None:
+            raise self.error
+        return self.playlist
+
+    def reload(self):
+        self.path, playlist = load_playlist(self.connection, self.path)
+        with self._cond:
+            self.playlist = playlist
+            self._loaded = time.monotonic()
+            self._cond.notify_all()
+        return playlist
+
+    def _maybe_reload(self, sequence):
+        """ Live playlists grow, reload if the player is ahead of what we know """
+        playlist = self.playlist
+        if playlist.ended or sequence <= playlist.last:
+            return
+        if time.monotonic() - self._loaded >= (playlist.target_duration or 10) / 2:
+            self.reload()
+
+    def get(self, sequence, timeout=60.0):
+        self.wait_loaded(timeout)
+        self._maybe_reload(sequence)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self.playlist.segment(sequence) is None:
+                raise KeyError(sequence)
+            if sequence != self.position:
+                self.position = sequence
+                self.errors.pop(sequence, None)
+                self._evict()
+                self._cond.notify_all()
+
+            while sequence not in self.buffer:
+                if sequence in self.errors:
+                    raise self.errors.pop(sequence)
+                remaining = deadline - time.monotonic()
+                if self.closed or remaining <= 0:
+                    raise TimeoutError("Segment %d not available" % sequence)
+                self._cond.wait(remaining)
+            return self.buffer[sequence]
+
+    def _wanted(self):
+        """ The next segment to download, or None """
+        for sequence in range(self.position, self.position + self.prefetch + 1):
+            if self.playlist.segment(sequence) is None:
+                return None
+            if sequence not in self.buffer and sequence not in self.pending and sequence not in self.errors:
+                return sequence
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                sequence = self._wanted()
+                while sequence is None and not self.closed:
+                    self._cond.wait()
+                    sequence = self._wanted()
+                if self.closed:
+                    return
+                self.pending.add(sequence)
+                segment = self.playlist.segment(sequence)
+
+            try:
+                data = self._fetch(segment)
+            except Exception as e:
+                logger.warning("Could not load segment %d: %s" % (sequence, e))
+                with self._cond:
+                    self.pending.discard(sequence)
+                    self.errors[sequence] = e
+                    self._cond.notify_all()
+                continue
+
+            with self._cond:
+                self.pending.discard(sequence)
+                if sequence not in self.buffer:
+                    self.buffer[sequence] = data
+                    self.size += len(data)
+                self._evict()
+                self._cond.notify_all()
+
+    def _fetch(self, segment):
+        return self.connection._request("GET", segment.uri, measure=True).content
+
+    def _evict(self):
+        # Keep the segment before the position around for players that re-request it
+        window = range(self.position - 1, self.position + self.prefetch + 1)
+        for sequence in sorted(self.buffer, key=lambda s: abs(s - self.position), reverse=True):
+            if sequence in window and self.size <= self.max_bytes:
+                break
+            if sequence == self.position:
+                continue
+            self.size -= len(self.buffer.pop(sequence))
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self.buffer.clear()
+            self.size = 0
+            self._cond.notify_all()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("Player: " + format % args)
+
+    def reply(self, status, content_type="text/plain", body=b""):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        prefetcher = self.server.prefetcher
+        path = urllib.parse.urlsplit(self.path).path
+
+        if path == "/index.m3u8":
+            try:
+                playlist = prefetcher.wait_loaded()
+                if not playlist.ended:
+                    playlist = prefetcher.reload()
+            except Exception as e:
+                logger.warning("Could not serve playlist: %s" % e)
+                return self.reply(502)
+            body = playlist.render(lambda segment: "segment/%d.ts" % segment.sequence)
+            return self.reply(200, "application/vnd.apple.mpegurl", body.encode("utf-8"))
+
+        name = path.rpartition("/")[2]
+        if path.startswith("/segment/") and name.endswith(".ts") and name[:-3].isdigit():
+            try:
+                data = prefetcher.get(int(name[:-3]))
+            except KeyError:
+                return self.reply(404)
+            except Exception as e:
+                logger.warning("Could not serve segment %s: %s" % (name, e))
+                return self.reply(502)
+            return self.reply(200, "video/MP2T", data)
+
+        self.reply(404)
+
+
+class HLSProxy:
+    """
+    Serves an HLS transcode to a local player
+
+    The proxy is serving as soon as it is created, hand url to the player. The playlist is loaded and
+    segments are prefetched in the background, requests from the player wait for them.
+    """
+
+    def __init__(self, connection, path, prefetch=4, workers=2, max_bytes=64 << 20):
+        self.prefetcher = SegmentPrefetcher(connection, path, prefetch, workers, max_bytes).start()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.prefetcher = self.prefetcher
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True, name="comPlex HLS proxy")
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/index.m3u8" % self.server.server_address[1]
+
+    @classmethod
+    def from_session(cls, session, **kwargs):
+        """ Proxy a TranscodeSession created with ext="m3u8" """
+        return cls(session.connection, session.path, **kwargs)
+
+    def close(self):
+        self.prefetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
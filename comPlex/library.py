@@ -25,6 +25,23 @@ class XmlLibraryItem(XmlItem):
     thumbnail_path = XmlAttrib("thumb")
     summary = XmlAttrib("summary")
     type = XmlAttrib("type")
+    updated_at = XmlAttrib("updatedAt", type=int)
+
+    def get_thumbnail(self, width=None, height=None):
+        """
+        Download the thumbnail, see Connection.get_photo
+        """
+        if not self.thumbnail_path:
+            return None
+        return self.connection.get_photo(self.thumbnail_path, width, height)
+
+    @classmethod
+    def from_store(cls, conn, key):
+        """
+        Load an item from the connection's MetadataStore without contacting the server
+        """
+        xml = conn.store.get_item(conn.uuid, key)
+        return cls(conn, xml) if xml is not None else None
 
 
 class BaseContainer(XmlLibraryItem):
@@ -46,12 +63,22 @@ class BaseContainer(XmlLibraryItem):
     @property
     def children_xml(self):
         if self._children_xml is None:
-            self._children_xml = self.connection.xml(self.children_xml_path).getroot()
+            self._children_xml = self.connection.container(self.children_xml_path, self.updated_at)
         return self._children_xml
 
     def get_children(self):
+        if self._children_xml is not None:
+            return [create_item(self.connection, child)
+                    for child in self.children_xml]
         return [create_item(self.connection, child)
-                for child in self.children_xml]
+                for child in self.connection.children(self.children_xml_path, self.updated_at)]
+
+    def iter_children(self, page_size=None):
+        """
+        Lazily yield the children, fetching them from the server page by page
+        """
+        for child in self.connection.iter_children(self.children_xml_path, self.updated_at, page_size=page_size):
+            yield create_item(self.connection, child)
 
     def __getitem__(self, item):
         if isinstance(item, slice):
@@ -69,11 +96,29 @@ class Container(BaseContainer):
 
     children_xml_path = XmlAttrib("key")
 
+    def mark_watched(self):
+        """ Mark everything in the container watched, e.g. a whole season """
+        if self.connection.mutations is not None:
+            return self.connection.mutations.mark_watched(self)
+        self.viewedCount = self.leafCount
+        return self.connection.ping('/:/scrobble?key=%s&identifier=com.plexapp.plugins.library' % self.key)
+
+    def mark_unwatched(self):
+        if self.connection.mutations is not None:
+            return self.connection.mutations.mark_unwatched(self)
+        self.viewedCount = 0
+        return self.connection.ping('/:/unscrobble?key=%s&identifier=com.plexapp.plugins.library' % self.key)
+
 
 class Section(BaseContainer):
     title = XmlAttrib("title", "Unknown Section")
     uuid = XmlAttrib("uuid", "")
 
+    @classmethod
+    def from_store(cls, conn, key):
+        xml = conn.store.get_section(conn.uuid, key)
+        return cls(conn, xml) if xml is not None else None
+
     @property
     def path(self):
         return "/library/sections/%s" % self._key
@@ -83,10 +128,21 @@ class Section(BaseContainer):
         return self.path + "/all"
 
     def get_items(self, key="all"):
+        if key == "all":
+            return self.get_children()
         return [create_item(self.connection, child)
-                for child in self.connection.xml(self.path + "/" + key).getroot()]
+                for child in self.connection.stream(self.path + "/" + key)]
+
+    def iter_items(self, key="all", page_size=None):
+        """
+        Lazily yield the items, fetching them from the server page by page
+        """
+        for child in self.connection.iter_xml(self.path + "/" + key, page_size=page_size):
+            yield create_item(self.connection, child)
 
     def refresh(self):
+        if self.connection.mutations is not None:
+            return self.connection.mutations.refresh_section(self)
         return self.connection.ping('/library/sections/%s/refresh' % self._key)
 
 
@@ -111,10 +167,14 @@ class Video(XmlLibraryItem):
         return [Media(self, media, i) for i, media in enumerate(self.xml.iterchildren("Media"))]
 
     def mark_watched(self):
+        if self.connection.mutations is not None:
+            return self.connection.mutations.mark_watched(self)
         self.views += 1
         return self.connection.ping('/:/scrobble?key=%s&identifier=com.plexapp.plugins.library' % self.key)
 
     def mark_unwatched(self):
+        if self.connection.mutations is not None:
+            return self.connection.mutations.mark_unwatched(self)
         self.views = 0
         return self.connection.ping('/:/unscrobble?key=%s&identifier=com.plexapp.plugins.library' % self.key)
 
@@ -177,7 +237,12 @@ class MediaPart(XmlItem):
 
 
 def create_item(conn, xml):
-    return {
+    item = {
         "Directory": Container,
         "Video": Video,
     }[xml.tag](conn, xml)
+
+    for observer in getattr(conn, "item_observers", ()):
+        observer(item)
+
+    return item
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Request and parse metrics per endpoint
+#
+# Paths are normalized so that requests for different items share an endpoint,
+# e.g. /library/metadata/1234/children becomes /library/metadata/{id}/children.
+
+import re
+import bisect
+import threading
+import collections
+
+# Numeric file names count as ids too, e.g. HLS segments like /00012.ts
+_ids = re.compile(r"/(?:\d+(?:,\d+)*|[0-9a-fA-F-]{16,})(?=/|$|\.\w+$)")
+
+
+def normalize_path(path):
+    """ Strip the query and replace numeric and hex ids with {id} """
+    return _ids.sub("/{id}", path.partition("?")[0])
+
+
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """ Counts observations into buckets by upper bound, like a Prometheus histogram """
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The last bucket counts observations above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """ Estimate a quantile by the upper bound of the bucket containing it """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def cumulative(self):
+        """ (upper bound, count of observations <= bound) pairs, ending with +Inf """
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum, "buckets": dict(self.cumulative())}
+
+
+class EndpointMetrics:
+    """ Everything recorded for one method and endpoint """
+
+    def __init__(self, method, endpoint):
+        self.method = method
+        self.endpoint = endpoint
+        self.latency = Histogram()
+        self.parse_time = Histogram()
+        self.status = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes = 0
+        self.elements = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def requests(self):
+        return sum(self.status.values())
+
+    def snapshot(self):
+        return {
+            "method": self.method,
+            "endpoint": self.endpoint,
+            "requests": self.requests,
+            "status": dict(self.status),
+            "errors": dict(self.errors),
+            "latency": self.latency.snapshot(),
+            "parse_time": self.parse_time.snapshot(),
+            "bytes": self.bytes,
+            "elements": self.elements,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+    def __repr__(self):
+        return "<EndpointMetrics %s %s: %d requests, p50 %s>" % (self.method, self.endpoint, self.requests,
+                                                                 self.latency.quantile(0.5))
+
+
+class Metrics:
+    """
+    Collects metrics per endpoint
+
+    latency is the time until the response headers arrived (the whole body for requests that are
+    not streamed), parse_time the time spent parsing the XML, which for streamed responses includes
+    waiting for the data. Bytes are counted as received, i.e. before decompression.
+    """
+
+    def __init__(self, prefix="complex"):
+        self.prefix = prefix
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def endpoint(self, method, path):
+        key = method.upper(), normalize_path(path)
+        metrics = self._endpoints.get(key)
+        if metrics is None:
+            with self._lock:
+                metrics = self._endpoints.setdefault(key, EndpointMetrics(*key))
+        return metrics
+
+    def endpoints(self):
+        with self._lock:
+            return sorted(self._endpoints.values(), key=lambda metrics: (metrics.endpoint, metrics.method))
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    # Recording
+    def observe_request(self, method, path, seconds, status, size=0):
+        metrics = self.endpoint(method, path)
+        with self._lock:
+            metrics.latency.observe(seconds)
+            metrics.status[status] += 1
+            metrics.bytes += size
+
+    def observe_error(self, method, path, error):
+        metrics = self.endpoint(method, path)
+        with self._lock:
+            metrics.errors[error] += 1
+
+    def observe_body(self, method, path, size=0, seconds=None, elements=0):
+        metrics = self.endpoint(method, path)
+        with self._lock:
+            metrics.bytes += size
+            metrics.elements += elements
+            if seconds is not None:
+                metrics.parse_time.observe(seconds)
+
+    def observe_cache(self, method, path, hit):
+        metrics = self.endpoint(method, path)
+        with self._lock:
+            if hit:
+                metrics.cache_hits += 1
+            else:
+                metrics.cache_misses += 1
+
+    # Export
+    def snapshot(self):
+        """ All metrics as a list of plain dicts """
+        with self._lock:
+            return [metrics.snapshot() for metrics in sorted(self._endpoints.values(),
+                                                             key=lambda m: (m.endpoint, m.method))]
+
+    def prometheus(self):
+        """ Render all metrics in the Prometheus text exposition format """
+        lines = []
+        p = self.prefix
+
+        def family(name, type, help):
+            lines.append("# HELP %s_%s %s" % (p, name, help))
+            lines.append("# TYPE %s_%s %s" % (p, name, type))
+
+        def sample(name, labels, value):
+            lines.append("%s_%s{%s} %s" % (p, name, ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels),
+                                           _number(value)))
+
+        def histogram(name, labels, hist):
+            for bound, count in hist.cumulative():
+                sample(name + "_bucket", labels + [("le", _number(bound))], count)
+            sample(name + "_sum", labels, hist.sum)
+            sample(name + "_count", labels, hist.count)
+
+        with self._lock:
+            endpoints = sorted(self._endpoints.values(), key=lambda m: (m.endpoint, m.method))
+
+            family("requests_total", "counter", "Requests by response status")
+            for m in endpoints:
+                for status, count in sorted(m.status.items()):
+                    sample("requests_total", [("method", m.method), ("endpoint", m.endpoint),
+                                              ("status", status)], count)
+
+            family("request_errors_total", "counter", "Failed requests by error")
+            for m in endpoints:
+                for error, count in sorted(m.errors.items()):
+                    sample("request_errors_total", [("method", m.method), ("endpoint", m.endpoint),
+                                                    ("error", error)], count)
+
+            family("request_duration_seconds", "histogram", "Time until the response arrived")
+            for m in endpoints:
+                if m.latency.count:
+                    histogram("request_duration_seconds", [("method", m.method), ("endpoint", m.endpoint)],
+                              m.latency)
+
+            family("response_bytes_total", "counter", "Response bytes received")
+            for m in endpoints:
+                sample("response_bytes_total", [("method", m.method), ("endpoint", m.endpoint)], m.bytes)
+
+            family("parse_duration_seconds", "histogram", "Time spent parsing responses")
+            for m in endpoints:
+                if m.parse_time.count:
+                    histogram("parse_duration_seconds", [("method", m.method), ("endpoint", m.endpoint)],
+                              m.parse_time)
+
+            family("parsed_elements_total", "counter", "Top-level elements parsed from responses")
+            for m in endpoints:
+                if m.parse_time.count:
+                    sample("parsed_elements_total", [("method", m.method), ("endpoint", m.endpoint)], m.elements)
+
+            family("cache_requests_total", "counter", "Response cache lookups")
+            for m in endpoints:
+                if m.cache_hits or m.cache_misses:
+                    labels = [("method", m.method), ("endpoint", m.endpoint)]
+                    sample("cache_requests_total", labels + [("result", "hit")], m.cache_hits)
+                    sample("cache_requests_total", labels + [("result", "miss")], m.cache_misses)
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
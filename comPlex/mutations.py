@@ -0,0 +1,334 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Write-behind queue for library changes
+#
+# Changes are applied to the local objects right away and journaled to SQLite, then sent to
+# the server in the background. Whatever wasn't sent is replayed on the next start.
+#
+# Mutations are sent in journal order. One only overtakes an earlier one if neither's target
+# contains the other's, e.g. two episodes can be sent side by side, but not an episode and its season.
+
+import time
+import sqlite3
+import logging
+import threading
+import concurrent.futures
+
+from .connection import ConnectionError, OfflineError, UnauthorizedError, InvalidResponseError, RETRY_STATUS_CODES
+
+logger = logging.getLogger("comPlex.mutations")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mutations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    server TEXT,
+    target TEXT,
+    kind TEXT,
+    method TEXT,
+    path TEXT,
+    created REAL,
+    attempts INTEGER DEFAULT 0,
+    parents TEXT DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS mutations_target ON mutations (server, target, kind);
+"""
+
+# The item's containers, see Mutation.parents
+PARENT_ATTRIBUTES = ("parentRatingKey", "grandparentRatingKey")
+
+
+class Mutation:
+    """
+    One journaled request
+
+    Mutations of the same kind on the same target supersede each other, e.g. a later
+    unwatch replaces a pending watch of the same item, so only the last one is sent.
+    parents are the keys of the containers the target is in, e.g. an episode's season and show.
+    """
+    __slots__ = ("id", "target", "kind", "method", "path", "attempts", "parents")
+
+    def __init__(self, id, target, kind, method, path, attempts=0, parents=()):
+        self.id = id
+        self.target = target
+        self.kind = kind
+        self.method = method
+        self.path = path
+        self.attempts = attempts
+        self.parents = tuple(parents)
+
+    @property
+    def scope(self):
+        """ The target and everything containing it """
+        return (self.target,) + self.parents
+
+    def __repr__(self):
+        return "<Mutation %s %s %s %s>" % (self.id, self.kind, self.method, self.path)
+
+
+class MutationQueue:
+    """
+    Durable write-behind queue of library changes for a connection
+
+    Pending mutations are sent in order, at most max_parallel at a time; mutations on the same or
+    overlapping targets (an episode and its season) one after the other. While the server can't be reached, sending is retried every retry_interval seconds.
+    Mutations the server keeps rejecting are dropped after max_attempts.
+
+    Set connection.mutations to a queue to make Video.mark_watched() and friends use it.
+    """
+
+    def __init__(self, connection, path, max_parallel=4, retry_interval=30.0, max_attempts=5):
+        self.connection = connection
+        self.path = path
+        self.max_parallel = max_parallel
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        # Journals written before parents were recorded
+        if "parents" not in [row[1] for row in self.db.execute("PRAGMA table_info(mutations)")]:
+            with self.db:
+                self.db.execute("ALTER TABLE mutations ADD COLUMN parents TEXT DEFAULT ''")
+        self._lock = threading.RLock()
+
+        # Targets with a request in flight
+        self._busy = set()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+        # Replay what was left over from the last run
+        if self.pending():
+            logger.info("Replaying %d pending library changes" % self.pending())
+            self._start()
+
+    @property
+    def server(self):
+        return self.connection.uuid or "%s:%s" % (self.connection.host, self.connection.port)
+
+    def pending(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM mutations WHERE server = ?", (self.server,)).fetchone()[0]
+
+    # Queueing
+    def enqueue(self, target, kind, path, method="GET", parents=()):
+        return self.enqueue_many([(target, kind, path, method, parents)])[0]
+
+    def enqueue_many(self, mutations):
+        """ Journal (target, kind, path, method[, parents]) tuples in one transaction """
+        server = self.server
+        created = []
+        with self._lock, self.db:
+            for target, kind, path, method, *parents in mutations:
+                target = str(target)
+                parents = [str(parent) for parent in (parents[0] if parents else ())]
+                self.db.execute("DELETE FROM mutations WHERE server = ? AND target = ? AND kind = ?",
+                                (server, target, kind))
+                cursor = self.db.execute("INSERT INTO mutations (server, target, kind, method, path, created, parents) "
+                                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         (server, target, kind, method, path, time.time(), " ".join(parents)))
+                created.append(Mutation(cursor.lastrowid, target, kind, method, path, 0, parents))
+        self._start()
+        return created
+
+    # Library changes
+    def mark_watched(self, *items):
+        """ Mark videos or whole containers (e.g. a season) watched """
+        for item in items:
+            if hasattr(item, "views"):
+                item.views += 1
+                self._update_store(item.key, "viewCount", str(item.views))
+            elif hasattr(item, "viewedCount"):
+                item.viewedCount = item.leafCount
+                self._update_store(item.key, "viewedLeafCount", str(item.leafCount))
+                self._update_children(item, True)
+        return self.enqueue_many((item.key, "watched", "/:/scrobble?key=%s&identifier=com.plexapp.plugins.library"
+                                  % item.key, "GET", self._parents(item)) for item in items)
+
+    def mark_unwatched(self, *items):
+        for item in items:
+            if hasattr(item, "views"):
+                item.views = 0
+                self._update_store(item.key, "viewCount", None)
+            elif hasattr(item, "viewedCount"):
+                item.viewedCount = 0
+                self._update_store(item.key, "viewedLeafCount", "0")
+                self._update_children(item, False)
+        return self.enqueue_many((item.key, "watched", "/:/unscrobble?key=%s&identifier=com.plexapp.plugins.library"
+                                  % item.key, "GET", self._parents(item)) for item in items)
+
+    @staticmethod
+    def _parents(item):
+        return [item.xml.get(attr) for attr in PARENT_ATTRIBUTES if item.xml.get(attr)]
+
+    def refresh_section(self, section):
+        return self.enqueue("section:%s" % section._key, "refresh", "/library/sections/%s/refresh" % section._key)
+
+    def set_audio_stream(self, part_id, stream_id):
+        return self.enqueue("part:%s" % part_id, "audio", "/library/parts/%s?audioStreamID=%s" % (part_id, stream_id),
+                            "PUT")
+
+    def set_subtitle_stream(self, part_id, stream_id):
+        return self.enqueue("part:%s" % part_id, "subtitle",
+                            "/library/parts/%s?subtitleStreamID=%s" % (part_id, stream_id), "PUT")
+
+    def _update_store(self, key, name, value):
+        """ Keep the stored copy in line, so it doesn't undo the change when browsing offline """
+        store = self.connection.store
+        if store is None:
+            return
+        xml = store.get_item(self.connection.uuid, key)
+        if xml is None:
+            return
+        if value is None:
+            xml.attrib.pop(name, None)
+        else:
+            xml.set(name, value)
+        store.put_items(self.connection.uuid, [xml])
+
+    @staticmethod
+    def _set_watched(xml, watched):
+        if xml.tag == "Video":
+            if not watched:
+                xml.attrib.pop("viewCount", None)
+            elif not int(xml.get("viewCount", 0)):
+                xml.set("viewCount", "1")
+        elif xml.get("leafCount") is not None:
+            xml.set("viewedLeafCount", xml.get("leafCount") if watched else "0")
+
+    def _update_children(self, container, watched):
+        """ Watching a container watches everything in it, both in its loaded children and in the store """
+        for xml in container._children_xml or ():
+            self._set_watched(xml, watched)
+
+        store = self.connection.store
+        if store is None:
+            return
+        changed = []
+        paths = [container.children_xml_path]
+        while paths:
+            for xml in store.get_children(self.connection.uuid, paths.pop()) or ():
+                if xml.get("ratingKey") is None:
+                    continue
+                self._set_watched(xml, watched)
+                changed.append(xml)
+                # Seasons of a show
+                if xml.tag == "Directory" and xml.get("key"):
+                    paths.append(xml.get("key"))
+        store.put_items(self.connection.uuid, changed)
+
+    # Sending
+    def _start(self):
+        with self._lock:
+            if self._closed:
+                return
+            if self._thread is None:
+                # A new thread flushes right away
+                self._thread = threading.Thread(target=self._run, daemon=True, name="comPlex mutations")
+                self._thread.start()
+                return
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            self.flush()
+            if self._closed:
+                return
+            # Whatever is left couldn't be sent, try again later unless something new comes in
+            self._wake.wait(self.retry_interval if self.pending() else None)
+
+    def _next(self, limit, exclude=()):
+        """
+        The oldest pending mutations that don't have to wait for an earlier one
+
+        A mutation waits for every earlier one, sent or not, whose target it contains or is contained in.
+        That includes mutations still in flight and those in exclude, which were rejected during this flush.
+        """
+        with self._lock:
+            rows = self.db.execute("SELECT id, target, kind, method, path, attempts, parents FROM mutations "
+                                   "WHERE server = ? ORDER BY id", (self.server,)).fetchall()
+            batch = []
+            # Targets and scopes of the mutations before the current one
+            targets = set()
+            scopes = set()
+            for row in rows:
+                mutation = Mutation(*row[:6], parents=(row[6] or "").split())
+                blocked = mutation.target in scopes or any(key in targets for key in mutation.scope)
+                targets.add(mutation.target)
+                scopes.update(mutation.scope)
+                if blocked or mutation.target in self._busy or mutation.id in exclude:
+                    continue
+                batch.append(mutation)
+                if len(batch) >= limit:
+                    break
+            self._busy.update(mutation.target for mutation in batch)
+            return batch
+
+    def flush(self, deadline=None):
+        """ Send pending mutations until none are left, returns False if the server couldn't be reached """
+        # Rejected mutations wait for the next flush
+        rejected = set()
+        with concurrent.futures.ThreadPoolExecutor(self.max_parallel) as executor:
+            while not self._closed:
+                batch = self._next(self.max_parallel, rejected)
+                if not batch:
+                    return True
+                results = list(executor.map(lambda mutation: self._send(mutation, deadline), batch))
+                if None in results:
+                    return False
+                rejected.update(mutation.id for mutation, sent in zip(batch, results) if not sent)
+        return True
+
+    def _send(self, mutation, deadline=None):
+        """ Send a mutation, returns True if it was sent, False if it was rejected, None if the server is offline """
+        try:
+            self.connection.ping(mutation.path, method=mutation.method, deadline=deadline)
+        except OfflineError as e:
+            logger.warning("Could not send %r, will retry: %s" % (mutation, e))
+            return None
+        except UnauthorizedError as e:
+            # Counts as a rejection, so a revoked token doesn't keep the queue retrying forever
+            self._failed(mutation, e)
+            return False
+        except InvalidResponseError as e:
+            if e.args and e.args[0] in RETRY_STATUS_CODES:
+                logger.warning("Server unavailable for %r, will retry" % mutation)
+                return None
+            self._failed(mutation, e)
+            return False
+        except ConnectionError as e:
+            self._failed(mutation, e)
+            return False
+        else:
+            with self._lock, self.db:
+                self.db.execute("DELETE FROM mutations WHERE id = ?", (mutation.id,))
+        finally:
+            with self._lock:
+                self._busy.discard(mutation.target)
+        return True
+
+    def _failed(self, mutation, error):
+        with self._lock, self.db:
+            if mutation.attempts + 1 >= self.max_attempts:
+                logger.error("Giving up on %r: %s" % (mutation, error))
+                self.db.execute("DELETE FROM mutations WHERE id = ?", (mutation.id,))
+            else:
+                logger.warning("Server rejected %r: %s" % (mutation, error))
+                self.db.execute("UPDATE mutations SET attempts = attempts + 1 WHERE id = ?", (mutation.id,))
+
+    def close(self, deadline=5.0):
+        """ Stop sending, what is left stays journaled for the next run """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wake.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(deadline)
+        if thread is None or not thread.is_alive():
+            with self._lock:
+                self.db.close()
@@ -11,7 +11,6 @@
 import time
 import uuid
 import logging
-import socket
 
 import urllib.parse
 
@@ -22,6 +21,8 @@ except ImportError:
 
 import requests
 
+from .client import resolve_hostname
+
 logger = logging.getLogger("comPlex.plexserver")
 logger.debug("Using Requests version for HTTP: %s" % requests.__version__)
 
@@ -39,7 +40,9 @@ class PlexMediaServer:
 
     @property
     def DeviceName(self):
-        return socket.gethostbyaddr(socket.gethostname())
+        if self.device_name is None:
+            self.device_name = resolve_hostname()
+        return self.device_name
 
     @property
     def ClientIdentifier(self):
@@ -119,7 +122,7 @@ class PlexMediaServer:
                 'class': self.class_type}
 
     def create_plex_identification(self):
-        headers = {"X-Plex-" + name: getattr(self, name.replace("-", "")
+        headers = {"X-Plex-" + name: getattr(self, name.replace("-", ""))
                    for name in ("Device", "Product", "Model", "Device-Name",
                                 "Version", "Language", "Provides", "Client-Identifier",
                                 "Platform", "Client-Platform", "Platform-Version")}
@@ -248,9 +251,9 @@ class PlexMediaServer:
             url = "%s://%s:%d%s" % (self.protocol, self.get_address(), self.port, path)
             try:
                 response = method(url, params=self.plex_identification_header, timeout=(2, 60))
-            except requests.exceptions.ConnectionError, e:
+            except requests.exceptions.ConnectionError as e:
                 logger.error("Server: %s is offline or uncontactable. error: %s" % (self.get_address(), e))
-            except requests.exceptions.ReadTimeout, e:
+            except requests.exceptions.ReadTimeout as e:
                 logger.warn("Server: read timeout for %s on %s " % (self.get_address(), url))
             else:
                 self.offline = False
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Compact, read-mostly representation of library items
+#
+# Records read all XmlAttrib declarations of their library class once and
+# store the converted values in __slots__, so the XML can be freed.
+# Attribute names are the same as on the library classes.
+
+import inspect
+
+from .dt import XmlAttrib
+from .library import Video, Media, MediaPart, create_item
+
+
+def xml_fields(cls):
+    """
+    Collect the XmlAttrib declarations of a class (including inherited ones) by attribute name
+    """
+    fields = {}
+    for name in dir(cls):
+        attr = inspect.getattr_static(cls, name)
+        if isinstance(attr, XmlAttrib):
+            fields[name] = attr
+    return fields
+
+
+class RecordMeta(type):
+    def __new__(mcs, name, bases, body, source=None, borrow=()):
+        if source is not None:
+            fields = xml_fields(source)
+            body["__slots__"] = tuple(fields) + tuple(body.get("__slots__", ()))
+            body["fields"] = fields
+            body["source"] = source
+            for attr in borrow:
+                body[attr] = inspect.getattr_static(source, attr)
+        return super().__new__(mcs, name, bases, body)
+
+    def __init__(cls, name, bases, body, source=None, borrow=()):
+        super().__init__(name, bases, body)
+
+
+class Record(metaclass=RecordMeta):
+    __slots__ = ("connection",)
+    fields = {}
+    source = None
+
+    def __init__(self, connection, xml):
+        self.connection = connection
+        for name, attrib in self.fields.items():
+            value = xml.get(attrib.name)
+            setattr(self, name, attrib.fallback if value is None else attrib.transform_get(value))
+
+
+class MediaPartRecord(Record, source=MediaPart):
+    __slots__ = ("media", "index")
+
+    def __init__(self, media, xml, index):
+        super().__init__(media.connection, xml)
+        self.media = media
+        self.index = index
+
+
+class MediaRecord(Record, source=Media, borrow=("__repr__",)):
+    __slots__ = ("video", "index", "parts")
+
+    def __init__(self, video, xml, index):
+        super().__init__(video.connection, xml)
+        self.video = video
+        self.index = index
+        self.parts = [MediaPartRecord(self, part, i) for i, part in enumerate(xml)]
+
+    def get_parts(self):
+        return self.parts
+
+
+class VideoRecord(Record, source=Video,
+                  borrow=("__repr__", "path", "get_thumbnail", "mark_watched", "mark_unwatched")):
+    __slots__ = ("formats",)
+
+    def __init__(self, connection, xml):
+        super().__init__(connection, xml)
+        self.formats = [MediaRecord(self, media, i) for i, media in enumerate(xml.iterchildren("Media"))]
+
+    def get_formats(self):
+        return self.formats
+
+
+RECORDS = {
+    Video: VideoRecord,
+}
+
+
+def create_record(conn, xml):
+    """
+    Like library.create_item, but returns records for the types that have one
+    """
+    return compact(create_item(conn, xml))
+
+
+def compact(item):
+    """
+    Convert a library item to its record, other objects are returned unchanged
+    """
+    record = RECORDS.get(type(item))
+    return record(item.connection, item.xml) if record is not None else item
+
+
+def compact_items(items):
+    """
+    Convert library items as they are produced, e.g. compact_items(section.iter_items())
+
+    Paired with the streaming iterators, the XML of each item can be freed right after conversion.
+    """
+    for item in items:
+        yield compact(item)
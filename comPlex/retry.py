@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Retry and circuit breaker policies for Connection
+
+import time
+import random
+import threading
+
+
+class Backoff:
+    """
+    Jittered exponential backoff
+
+    Retry n waits a random time between 0 and min(cap, base * 2 ** n) seconds ("full jitter"),
+    so clients failing at the same time don't retry in lockstep.
+    """
+
+    def __init__(self, retries=2, base=0.2, cap=5.0):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delays(self):
+        for n in range(self.retries):
+            yield random.uniform(0, min(self.cap, self.base * 2 ** n))
+
+
+class CircuitBreaker:
+    """
+    Stops talking to a host that keeps failing
+
+    After threshold consecutive failures the breaker opens and allow() returns False.
+    Once reset_timeout seconds have passed, a single trial request is allowed through (half-open):
+    it closes the breaker on success and opens it again on failure. A trial that reports neither
+    within another reset_timeout is given up on and the next request becomes the trial.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=3, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                # In half-open, when the trial was let through
+                self.opened = now
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened = time.monotonic()
+
+    def reset(self):
+        self.success()
+
+    def __repr__(self):
+        return "<CircuitBreaker %s (%d failures)>" % (self.state, self.failures)
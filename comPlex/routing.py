@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Route selection between the addresses of a server
+
+import time
+import logging
+import ipaddress
+import threading
+import concurrent.futures
+
+from .retry import CircuitBreaker
+from .bandwidth import BandwidthEstimator
+
+logger = logging.getLogger("comPlex.routing")
+
+
+class Route:
+    """
+    One address of a server
+
+    latency is the round trip of the last successful probe in seconds, healthy is False after a failure.
+    The breaker tracks failures of regular requests, bandwidth the throughput of media downloads.
+    """
+    __slots__ = ("host", "port", "latency", "healthy", "checked", "breaker", "bandwidth")
+
+    def __init__(self, host, port=32400):
+        self.host = host
+        self.port = port
+        self.latency = None
+        self.healthy = True
+        self.checked = None
+        self.breaker = CircuitBreaker()
+        self.bandwidth = BandwidthEstimator()
+
+    @property
+    def local(self):
+        try:
+            address = ipaddress.ip_address(self.host)
+        except ValueError:
+            return self.host == "localhost"
+        return address.is_private or address.is_loopback or address.is_link_local
+
+    def __repr__(self):
+        return "<Route %s:%d%s%s>" % (self.host, self.port,
+                                      " %.1fms" % (self.latency * 1000) if self.latency is not None else "",
+                                      "" if self.healthy else " down")
+
+
+class Router:
+    """
+    Chooses the fastest healthy route to a server
+
+    race() probes the candidates happy-eyeballs style: a new probe is started every stagger seconds
+    (or as soon as one fails) and the first route to answer wins. measure() probes all routes and
+    switches to a clearly faster one, monitor() does so periodically in the background.
+
+    probe(route, timeout) must return True if the server answered properly on that route.
+    on_switch(route) is called whenever the current route changes.
+    """
+
+    def __init__(self, probe, routes=(), on_switch=None, stagger=0.25, timeout=2.0, hysteresis=0.8):
+        self.probe = probe
+        self.on_switch = on_switch
+        self.routes = list(routes)
+        self.current = self.routes[0] if self.routes else None
+
+        self.stagger = stagger
+        self.timeout = timeout
+        # Only switch to a route taking less than this fraction of the current one's latency
+        self.hysteresis = hysteresis
+
+        self._lock = threading.RLock()
+        self._monitor = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add(self, host, port=32400):
+        with self._lock:
+            for route in self.routes:
+                if route.host == host and route.port == port:
+                    return route
+            route = Route(host, port)
+            self.routes.append(route)
+            if self.current is None:
+                self._switch(route)
+            return route
+
+    def _switch(self, route):
+        if route is not self.current:
+            logger.info("Switching route to %s:%d" % (route.host, route.port))
+            self.current = route
+            if self.on_switch is not None:
+                self.on_switch(route)
+
+    def _check(self, route):
+        start = time.monotonic()
+        try:
+            ok = self.probe(route, self.timeout)
+        except Exception as e:
+            logger.debug("Probe of %r failed: %s" % (route, e))
+            ok = False
+        route.checked = time.time()
+        route.healthy = bool(ok)
+        if ok:
+            route.latency = time.monotonic() - start
+            route.breaker.success()
+        return route if ok else None
+
+    def _candidates(self, exclude=()):
+        """ Order routes for racing: current first, then local ones, then by known latency """
+        def key(route):
+            return (route is not self.current,
+                    not route.local,
+                    not route.healthy,
+                    route.latency if route.latency is not None else float("inf"))
+        return sorted((route for route in self.routes if route not in exclude), key=key)
+
+    def race(self, exclude=()):
+        """
+        Find a working route and make it current
+
+        Returns the route, or None if no route answered within the timeout.
+        Probes still running after the winner answered complete in the background.
+        """
+        candidates = self._candidates(exclude)
+        if not candidates:
+            return None
+
+        executor = concurrent.futures.ThreadPoolExecutor(len(candidates))
+        deadline = time.monotonic() + self.timeout
+        pending = set()
+        winner = None
+        try:
+            while winner is None:
+                if candidates:
+                    pending.add(executor.submit(self._check, candidates.pop(0)))
+                    wait = self.stagger
+                else:
+                    wait = deadline - time.monotonic()
+
+                if not pending or wait <= 0:
+                    break
+
+                done, pending = concurrent.futures.wait(pending, wait, concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.result() is not None:
+                        winner = future.result()
+                        break
+        finally:
+            executor.shutdown(wait=False)
+
+        if winner is not None:
+            with self._lock:
+                self._switch(winner)
+        return winner
+
+    def fail(self, route):
+        """ Mark a route as broken and race the others, returns the new route or None """
+        route.healthy = False
+        logger.warning("Route %s:%d failed" % (route.host, route.port))
+        with self._lock:
+            if route is not self.current:
+                return self.current
+        return self.race(exclude=(route,))
+
+    def measure(self):
+        """ Probe all routes concurrently and switch if a clearly faster one is found """
+        if not self.routes:
+            return None
+
+        with concurrent.futures.ThreadPoolExecutor(len(self.routes)) as executor:
+            healthy = [route for route in executor.map(self._check, list(self.routes)) if route is not None]
+
+        with self._lock:
+            if not healthy:
+                return self.current
+            best = min(healthy, key=lambda route: route.latency)
+            current = self.current
+            if current is None or not current.healthy or current.latency is None or \
+                    best.latency < current.latency * self.hysteresis:
+                self._switch(best)
+            return self.current
+
+    # Background re-measuring
+    def monitor(self, interval=60.0):
+        """ Re-measure the routes every interval seconds in a background thread """
+        if self._monitor is not None:
+            return
+        self._stop.clear()
+        self._monitor = threading.Thread(target=self._run, args=(interval,), daemon=True,
+                                         name="comPlex route monitor")
+        self._monitor.start()
+
+    def stop(self):
+        if self._monitor is not None:
+            self._stop.set()
+            self._monitor.join()
+            self._monitor = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.measure()
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+
+import re
+import bisect
+import heapq
+import threading
+import unicodedata
+
+_word = re.compile(r"\w+")
+
+
+def normalize(text):
+    """ Lowercase and strip accents """
+    if text.isascii():
+        return text.lower()
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return _word.findall(normalize(text))
+
+
+class SearchHit:
+    """
+    A search result, get_item() fetches the full library item
+    """
+    __slots__ = ("connection", "rating_key", "title", "type")
+
+    def __init__(self, connection, rating_key, title, type):
+        self.connection = connection
+        self.rating_key = rating_key
+        self.title = title
+        self.type = type
+
+    def __repr__(self):
+        return "<SearchHit %s '%s' (%s)>" % (self.type, self.title, self.rating_key)
+
+    def get_item(self):
+        return self.connection.get_item(self.rating_key)
+
+
+class SearchIndex:
+    """
+    In-memory full-text index over library items
+
+    Indexes the title, originalTitle, summary and year attributes as well as Genre and Role tags.
+    Query terms must all match; the last one is matched as a prefix so the index can be used
+    while typing. Items whose title starts with the query come first, the rest is ordered by title.
+
+    Items can be added at any time, e.g. by attaching the index to a Connection.
+    Only SearchHits are kept, not the items themselves.
+    """
+    ATTRIBUTES = ("title", "originalTitle", "summary", "year")
+    TAGS = ("Genre", "Role")
+
+    # Above this many candidates, walk the title order instead of sorting the candidates
+    SCAN_THRESHOLD = 20000
+    # Up to this many tokens matching the prefix, check candidates against their postings
+    PREFIX_TOKENS = 64
+
+    def __init__(self):
+        self.ids = {}
+        self.hits = []
+        self.doc_tokens = []
+        self.doc_titles = []
+        self.postings = {}
+
+        # Sorted lookup structures, new entries are merged in on the next query
+        self.tokens = []
+        self.titles = []
+        self._new_tokens = []
+        self._new_titles = []
+        # Entries in titles whose document was updated or removed since, skipped while walking
+        self._stale_titles = 0
+
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def attach(self, connection):
+        """ Index every item created for connection from now on """
+        connection.item_observers.append(self.add)
+
+    def detach(self, connection):
+        connection.item_observers.remove(self.add)
+
+    # Indexing
+    def _document(self, xml):
+        tokens = set()
+        for attr in self.ATTRIBUTES:
+            value = xml.get(attr)
+            if value:
+                tokens.update(tokenize(value))
+        for child in xml:
+            if child.tag in self.TAGS and child.get("tag"):
+                tokens.update(tokenize(child.get("tag")))
+        return tokens
+
+    def add(self, item, xml=None):
+        """
+        Add or update an item
+
+        xml defaults to item.xml, pass it explicitly for items that don't keep their XML.
+        """
+        if xml is None:
+            xml = item.xml
+        self.add_xml(item.connection, xml)
+
+    def add_xml(self, connection, xml):
+        rating_key = xml.get("ratingKey")
+        if rating_key is None:
+            return
+
+        key = (connection.uuid if connection is not None else None, rating_key)
+        tokens = self._document(xml)
+        # Tokenized like the query, so "spider man" finds "Spider-Man"
+        title = " ".join(tokenize(xml.get("title", "")))
+        hit = SearchHit(connection, rating_key, xml.get("title"), xml.get("type"))
+
+        with self._lock:
+            doc = self.ids.get(key)
+            if doc is None:
+                doc = self.ids[key] = len(self.hits)
+                self.hits.append(hit)
+                self.doc_tokens.append(set())
+                self.doc_titles.append(None)
+            else:
+                self.hits[doc] = hit
+                if tokens == self.doc_tokens[doc] and title == self.doc_titles[doc]:
+                    # Seen before, unchanged
+                    return
+                self._unindex(doc)
+
+            for token in tokens:
+                posting = self.postings.get(token)
+                if posting is None:
+                    posting = self.postings[token] = set()
+                    self._new_tokens.append(token)
+                posting.add(doc)
+
+            self.doc_tokens[doc] = tokens
+            self.doc_titles[doc] = title
+            self._new_titles.append((title, doc))
+
+    def remove(self, server, rating_key):
+        with self._lock:
+            doc = self.ids.pop((server, str(rating_key)), None)
+            if doc is not None:
+                self._unindex(doc)
+                self.hits[doc] = None
+                self.doc_tokens[doc] = set()
+                self.doc_titles[doc] = None
+
+    def _unindex(self, doc):
+        for token in self.doc_tokens[doc]:
+            self.postings[token].discard(doc)
+        # The old title entry stays until enough of them piled up
+        self._stale_titles += 1
+
+    def _merge(self):
+        if self._new_tokens:
+            self.tokens.extend(self._new_tokens)
+            self.tokens.sort()
+            self._new_tokens = []
+        if self._stale_titles > len(self.titles) // 2:
+            # Still sorted, an entry re-added with the same title is next to its old copy
+            titles = []
+            for entry in self.titles:
+                if self._current(entry) and (not titles or titles[-1] != entry):
+                    titles.append(entry)
+            self.titles = titles
+            self._stale_titles = 0
+        if self._new_titles:
+            if len(self._new_titles) < 64:
+                for entry in self._new_titles:
+                    bisect.insort(self.titles, entry)
+            else:
+                self.titles.extend(self._new_titles)
+                self.titles.sort()
+            self._new_titles = []
+
+    def _current(self, entry):
+        return self.doc_titles[entry[1]] == entry[0]
+
+    # Querying
+    def _prefix_tokens(self, prefix):
+        i = bisect.bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            yield self.tokens[i]
+            i += 1
+
+    def _title_prefix(self, prefix, results):
+        i = bisect.bisect_left(self.titles, (prefix,))
+        while i < len(self.titles) and not results.full() and self.titles[i][0].startswith(prefix):
+            if self._current(self.titles[i]):
+                results.add(self.titles[i][1])
+            i += 1
+
+    def search(self, query, limit=50):
+        """
+        Find items matching query, returns at most limit SearchHits
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        with self._lock:
+            self._merge()
+
+            results = _Results(limit)
+            self._title_prefix(" ".join(terms), results)
+            if results.full():
+                return results.hits(self.hits)
+
+            exact, prefix = terms[:-1], terms[-1]
+
+            # Estimate the number of candidates from the most selective term
+            postings = []
+            for term in exact:
+                posting = self.postings.get(term)
+                if not posting:
+                    return results.hits(self.hits)
+                postings.append(posting)
+            postings.sort(key=len)
+
+            # Collect the postings of the prefix until they are useless for both strategies below
+            prefix_postings = []
+            prefix_size = 0
+            complete = True
+            for token in self._prefix_tokens(prefix):
+                if prefix_size > self.SCAN_THRESHOLD and len(prefix_postings) >= self.PREFIX_TOKENS:
+                    complete = False
+                    break
+                posting = self.postings[token]
+                prefix_postings.append(posting)
+                prefix_size += len(posting)
+            if not prefix_postings:
+                return results.hits(self.hits)
+            if not complete:
+                prefix_size = self.SCAN_THRESHOLD + 1
+
+            if complete and len(prefix_postings) <= self.PREFIX_TOKENS:
+                def matches_prefix(doc):
+                    return any(doc in posting for posting in prefix_postings)
+            else:
+                def matches_prefix(doc):
+                    return any(token.startswith(prefix) for token in self.doc_tokens[doc])
+
+            if prefix_size <= self.SCAN_THRESHOLD:
+                candidates = set().union(*prefix_postings)
+                for posting in postings:
+                    candidates &= posting
+            elif postings and len(postings[0]) <= self.SCAN_THRESHOLD:
+                candidates = set(postings[0])
+                for posting in postings[1:]:
+                    candidates &= posting
+                candidates = {doc for doc in candidates if matches_prefix(doc)}
+            else:
+                candidates = None
+
+            if candidates is not None:
+                titles = self.doc_titles
+                for doc in heapq.nsmallest(limit, candidates, key=titles.__getitem__):
+                    results.add(doc)
+            else:
+                # Dense match, walk the titles in order
+                for entry in self.titles:
+                    if results.full():
+                        break
+                    if not self._current(entry):
+                        continue
+                    doc = entry[1]
+                    tokens = self.doc_tokens[doc]
+                    if all(term in tokens for term in exact) and matches_prefix(doc):
+                        results.add(doc)
+
+            return results.hits(self.hits)
+
+
+class _Results:
+    """ Ordered, duplicate-free, size-limited list of document ids """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.docs = []
+        self.seen = set()
+
+    def full(self):
+        return len(self.docs) >= self.maxlen
+
+    def add(self, doc):
+        if doc not in self.seen and not self.full():
+            self.seen.add(doc)
+            self.docs.append(doc)
+
+    def hits(self, hits):
+        return [hits[doc] for doc in self.docs if hits[doc] is not None]
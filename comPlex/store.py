@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+
+import sqlite3
+import threading
+
+try:
+    from lxml import etree
+except ImportError:
+    from xml.etree import ElementTree as etree
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS servers (
+    server TEXT PRIMARY KEY,
+    name TEXT,
+    host TEXT,
+    port INTEGER
+);
+CREATE TABLE IF NOT EXISTS sections (
+    server TEXT,
+    key TEXT,
+    position INTEGER,
+    xml BLOB,
+    PRIMARY KEY (server, key)
+);
+CREATE TABLE IF NOT EXISTS items (
+    server TEXT,
+    rating_key TEXT,
+    updated_at INTEGER,
+    xml BLOB,
+    PRIMARY KEY (server, rating_key)
+);
+CREATE TABLE IF NOT EXISTS containers (
+    server TEXT,
+    path TEXT,
+    updated_at INTEGER,
+    PRIMARY KEY (server, path)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    server TEXT,
+    section TEXT,
+    type TEXT,
+    high_water INTEGER,
+    PRIMARY KEY (server, section, type)
+);
+CREATE TABLE IF NOT EXISTS section_keys (
+    server TEXT,
+    section TEXT,
+    type TEXT,
+    rating_key TEXT,
+    PRIMARY KEY (server, section, type, rating_key)
+);
+CREATE TABLE IF NOT EXISTS children (
+    server TEXT,
+    path TEXT,
+    position INTEGER,
+    rating_key TEXT,
+    xml BLOB,
+    PRIMARY KEY (server, path, position)
+);
+"""
+
+
+def updated_at(xml):
+    try:
+        return int(xml.get("updatedAt"))
+    except (TypeError, ValueError):
+        return None
+
+
+class MetadataStore:
+    """
+    SQLite-backed copy of the library metadata
+
+    Everything is keyed by the server's machineIdentifier. Items are stored by ratingKey,
+    containers remember the updatedAt of the container at the time the children were stored.
+    Stored data is considered fresh as long as the server reports the same (or an older) updatedAt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self._lock = threading.RLock()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    # Servers
+    def put_server(self, server, name, host, port):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO servers VALUES (?, ?, ?, ?)", (server, name, host, port))
+
+    def find_server(self, host, port):
+        """ Returns (machineIdentifier, name) of the server last seen at host:port """
+        with self._lock:
+            return self.db.execute("SELECT server, name FROM servers WHERE host = ? AND port = ?",
+                                   (host, port)).fetchone()
+
+    # Sections
+    def put_sections(self, server, sections):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM sections WHERE server = ?", (server,))
+            self.db.executemany("INSERT INTO sections VALUES (?, ?, ?, ?)",
+                                ((server, xml.get("key"), i, etree.tostring(xml)) for i, xml in enumerate(sections)))
+
+    def get_sections(self, server):
+        with self._lock:
+            rows = self.db.execute("SELECT xml FROM sections WHERE server = ? ORDER BY position", (server,)).fetchall()
+        return [etree.fromstring(xml) for xml, in rows]
+
+    def get_section(self, server, key):
+        with self._lock:
+            row = self.db.execute("SELECT xml FROM sections WHERE server = ? AND key = ?", (server, key)).fetchone()
+        return etree.fromstring(row[0]) if row else None
+
+    # Items
+    def _put_item(self, server, xml):
+        self.db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)",
+                        (server, xml.get("ratingKey"), updated_at(xml), etree.tostring(xml)))
+
+    def put_items(self, server, items):
+        with self._lock, self.db:
+            for xml in items:
+                if xml.get("ratingKey") is not None:
+                    self._put_item(server, xml)
+
+    def get_item(self, server, rating_key, updated=None):
+        """
+        Look up an item by ratingKey
+
+        If updated is given, only return the stored item if it is at least that recent.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT updated_at, xml FROM items WHERE server = ? AND rating_key = ?",
+                                  (server, str(rating_key))).fetchone()
+        if row is None or not self.is_fresh(row[0], updated):
+            return None
+        return etree.fromstring(row[1])
+
+    def iter_items(self, server):
+        """ Iterate all stored items of a server """
+        with self._lock:
+            rows = self.db.execute("SELECT xml FROM items WHERE server = ?", (server,)).fetchall()
+        for xml, in rows:
+            yield etree.fromstring(xml)
+
+    def delete_items(self, server, rating_keys):
+        with self._lock, self.db:
+            self.db.executemany("DELETE FROM items WHERE server = ? AND rating_key = ?",
+                                ((server, str(key)) for key in rating_keys))
+
+    # Container contents
+    def put_children(self, server, path, children, updated=None):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM children WHERE server = ? AND path = ?", (server, path))
+            for i, xml in enumerate(children):
+                key = xml.get("ratingKey")
+                if key is not None:
+                    self._put_item(server, xml)
+                    self.db.execute("INSERT INTO children VALUES (?, ?, ?, ?, NULL)", (server, path, i, key))
+                else:
+                    self.db.execute("INSERT INTO children VALUES (?, ?, ?, NULL, ?)",
+                                    (server, path, i, etree.tostring(xml)))
+            self.db.execute("INSERT OR REPLACE INTO containers VALUES (?, ?, ?)", (server, path, updated))
+
+    def get_children(self, server, path, updated=None):
+        """
+        Look up the stored children of a container
+
+        Returns None if nothing is stored or, when updated is given, the stored copy is older than that.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT updated_at FROM containers WHERE server = ? AND path = ?",
+                                  (server, path)).fetchone()
+            if row is None or not self.is_fresh(row[0], updated):
+                return None
+            rows = self.db.execute("SELECT COALESCE(c.xml, i.xml) FROM children c "
+                                   "LEFT JOIN items i ON i.server = c.server AND i.rating_key = c.rating_key "
+                                   "WHERE c.server = ? AND c.path = ? ORDER BY c.position",
+                                   (server, path)).fetchall()
+        return [etree.fromstring(xml) for xml, in rows if xml is not None]
+
+    # Sync state
+    def get_high_water(self, server, section, type=""):
+        with self._lock:
+            row = self.db.execute("SELECT high_water FROM sync_state WHERE server = ? AND section = ? AND type = ?",
+                                  (server, section, type)).fetchone()
+        return row[0] if row else None
+
+    def set_high_water(self, server, section, high_water, type=""):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+                            (server, section, type, high_water))
+
+    def get_section_keys(self, server, section, type=""):
+        with self._lock:
+            rows = self.db.execute("SELECT rating_key FROM section_keys WHERE server = ? AND section = ? AND type = ?",
+                                   (server, section, type)).fetchall()
+        return {key for key, in rows}
+
+    def update_section_keys(self, server, section, added=(), removed=(), type=""):
+        with self._lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO section_keys VALUES (?, ?, ?, ?)",
+                                ((server, section, type, key) for key in added))
+            self.db.executemany("DELETE FROM section_keys WHERE server = ? AND section = ? AND type = ? "
+                                "AND rating_key = ?", ((server, section, type, key) for key in removed))
+
+    # Freshness policy
+    @staticmethod
+    def is_fresh(stored, updated):
+        if updated is None:
+            return True
+        return stored is not None and stored >= updated
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+
+import time
+
+try:
+    from lxml import etree
+except ImportError:
+    from xml.etree import ElementTree as etree
+
+
+class XmlStream:
+    """
+    Incrementally parses a MediaContainer document
+
+    Iterating yields the top-level children as soon as their closing tag arrives.
+    Once the consumer moves on, the element is detached from the root so the document never grows;
+    elements the consumer keeps a reference to stay usable. With clear=True, their contents
+    are dropped as well, which is only useful for consumers that extract the data they need right away.
+
+    The root element (and with it, attributes like totalSize) is available as soon as iteration has started.
+    count is the number of top-level elements parsed so far, parse_time the time spent parsing
+    (and waiting for data), not counting the time the consumer spent with the elements.
+    """
+
+    def __init__(self, source, tags=("Directory", "Video"), *, clear=False, close=None):
+        self.source = source
+        self.tags = tags
+        self.clear = clear
+        self.root = None
+        self.count = 0
+        self.parse_time = 0.0
+        self._close = close
+
+    def __iter__(self):
+        depth = 0
+        resumed = time.perf_counter()
+        try:
+            for event, element in etree.iterparse(self.source, events=("start", "end")):
+                if event == "start":
+                    if depth == 0:
+                        self.root = element
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        self.count += 1
+                        if self.tags is None or element.tag in self.tags:
+                            self.parse_time += time.perf_counter() - resumed
+                            resumed = None
+                            yield element
+                            resumed = time.perf_counter()
+                        if self.clear:
+                            element.clear()
+                        self.root.remove(element)
+        finally:
+            if resumed is not None:
+                self.parse_time += time.perf_counter() - resumed
+            self.close()
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
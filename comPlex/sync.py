@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+
+import logging
+
+from .library import create_item
+
+logger = logging.getLogger("comPlex.sync")
+
+
+class ChangeSet:
+    """
+    Result of syncing a section
+
+    inserted and updated hold library items, deleted holds ratingKeys.
+    """
+
+    def __init__(self, section, type=""):
+        self.section = section
+        self.type = type
+        self.inserted = []
+        self.updated = []
+        self.deleted = []
+
+    def __bool__(self):
+        return bool(self.inserted or self.updated or self.deleted)
+
+    def __repr__(self):
+        return "<ChangeSet %s%s +%d ~%d -%d>" % (
+            self.section.title,
+            " (type %s)" % self.type if self.type else "",
+            len(self.inserted),
+            len(self.updated),
+            len(self.deleted),
+        )
+
+
+def timestamp(xml):
+    return max(int(xml.get("updatedAt", 0)), int(xml.get("addedAt", 0)))
+
+
+class LibrarySync:
+    """
+    Keeps a MetadataStore in sync with the server
+
+    The first sync of a section reads all of its items. After that, only items with an updatedAt
+    or addedAt newer than the section's high-water mark are requested. Deletions are detected by
+    comparing the server's item count with the stored one, and only then by diffing the ratingKeys.
+    """
+
+    def __init__(self, connection, store=None):
+        self.connection = connection
+        self.store = store if store is not None else connection.store
+
+    @property
+    def server(self):
+        return self.connection.uuid
+
+    def sync(self, types=None):
+        """
+        Sync all sections, returns a list of ChangeSets
+
+        types maps section types to a list of item types to sync, e.g. {"show": ["4"]} for episodes.
+        """
+        changes = []
+        for section in self.connection.get_sections():
+            for type in (types or {}).get(section.type, [""]):
+                changes.append(self.sync_section(section, type))
+        return changes
+
+    def _params(self, type, **params):
+        if type:
+            params["type"] = type
+        return params
+
+    def _total(self, section, type):
+        root = self.connection.xml(section.children_xml_path, params=self._params(type, **{
+            "X-Plex-Container-Start": 0,
+            "X-Plex-Container-Size": 0,
+        })).getroot()
+        return int(root.get("totalSize", root.get("size", 0)))
+
+    def _server_keys(self, section, type):
+        return {xml.get("ratingKey")
+                for xml in self.connection.stream(section.children_xml_path, params=self._params(type), clear=True)}
+
+    def sync_section(self, section, type=""):
+        changes = ChangeSet(section, type)
+        key = section._key
+        path = section.children_xml_path
+
+        high_water = self.store.get_high_water(self.server, key, type)
+        known = self.store.get_section_keys(self.server, key, type)
+
+        if high_water is None:
+            # Initial sync
+            logger.info("Initial sync of %s" % section.title)
+            elements = list(self.connection.stream(path, params=self._params(type)))
+            new_high_water = max((timestamp(xml) for xml in elements), default=0)
+        else:
+            elements = {}
+            for field in ("updatedAt", "addedAt"):
+                for xml in self.connection.stream(path, params=self._params(type, **{field + ">": high_water})):
+                    elements[xml.get("ratingKey")] = xml
+            elements = list(elements.values())
+            new_high_water = max([high_water] + [timestamp(xml) for xml in elements])
+
+        for xml in elements:
+            rating_key = xml.get("ratingKey")
+            if rating_key not in known:
+                changes.inserted.append(create_item(self.connection, xml))
+            elif high_water is not None and timestamp(xml) > high_water:
+                changes.updated.append(create_item(self.connection, xml))
+
+        # Deletions
+        if high_water is not None:
+            expected = len(known) + len(changes.inserted)
+            if self._total(section, type) != expected:
+                changes.deleted = list(known - self._server_keys(section, type))
+
+        self.store.put_items(self.server, elements)
+        self.store.delete_items(self.server, changes.deleted)
+        self.store.update_section_keys(self.server, key, (item.xml.get("ratingKey") for item in changes.inserted),
+                                       changes.deleted, type)
+        self.store.set_high_water(self.server, key, new_high_water, type)
+
+        logger.debug("Synced %r" % changes)
+        return changes
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+
+logger = logging.getLogger("comPlex.thumbcache")
+
+
+class ThumbnailKey:
+    """
+    Identifies a thumbnail of a given size
+
+    Plex thumbnail paths end in the timestamp of the artwork (/library/metadata/<id>/thumb/<timestamp>),
+    entries for the same image with a different timestamp are considered stale.
+    """
+    __slots__ = ("base", "version", "name")
+
+    def __init__(self, server, path, size=None):
+        base, _, version = path.rpartition("/")
+        if not version.isdigit():
+            base, version = path, ""
+
+        self.base = hashlib.sha1(("%s|%s|%s" % (server, base, size)).encode("utf-8")).hexdigest()
+        self.version = version
+        self.name = "%s-%s" % (self.base, version) if version else self.base
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __eq__(self, other):
+        return self.name == other.name
+
+    def __repr__(self):
+        return "<ThumbnailKey %s>" % self.name
+
+
+class ThumbnailCache:
+    """
+    Two-tier thumbnail cache
+
+    The memory tier keeps decoded images up to a byte budget, the cost of each image is supplied
+    by the caller. The disk tier keeps the encoded data below path, in directories sharded by the
+    first two hex digits of the key, up to a size limit. Both tiers evict the least recently used entries.
+    """
+
+    def __init__(self, path=None, max_memory=64 << 20, max_disk=512 << 20):
+        self.path = path
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+
+        self._memory = collections.OrderedDict()
+        self._memory_versions = {}
+        self.memory_size = 0
+        self.disk_size = 0
+
+        self.memory_hits = 0
+        self.memory_misses = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.RLock()
+
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.disk_size = sum(size for _, size, _ in self._disk_files())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "memory_misses": self.memory_misses,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_size": self.memory_size,
+                "disk_size": self.disk_size,
+            }
+
+    # Memory tier
+    def get_image(self, key):
+        with self._lock:
+            entry = self._memory.get(key.name)
+            if entry is None:
+                self.memory_misses += 1
+                return None
+            self._memory.move_to_end(key.name)
+            self.memory_hits += 1
+            return entry[0]
+
+    def put_image(self, key, image, cost):
+        with self._lock:
+            # Drop stale versions and older copies
+            old = self._memory_versions.get(key.base)
+            if old is not None:
+                self._memory_drop(old)
+
+            if cost > self.max_memory:
+                return
+
+            self._memory[key.name] = image, cost
+            self._memory_versions[key.base] = key.name
+            self.memory_size += cost
+
+            while self.memory_size > self.max_memory:
+                self._memory_drop(next(iter(self._memory)))
+                self.evictions += 1
+
+    def _memory_drop(self, name):
+        entry = self._memory.pop(name, None)
+        if entry is not None:
+            self.memory_size -= entry[1]
+            base = name.partition("-")[0]
+            if self._memory_versions.get(base) == name:
+                del self._memory_versions[base]
+
+    def set_max_memory(self, max_memory):
+        with self._lock:
+            self.max_memory = max_memory
+            while self.memory_size > self.max_memory:
+                self._memory_drop(next(iter(self._memory)))
+                self.evictions += 1
+
+    # Disk tier
+    def _disk_dir(self, key):
+        return os.path.join(self.path, key.base[:2])
+
+    def _disk_files(self):
+        for shard in os.scandir(self.path):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        stat = entry.stat()
+                        yield stat.st_mtime, stat.st_size, entry.path
+
+    def get_data(self, key):
+        if self.path is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        filename = os.path.join(self._disk_dir(key), key.name)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            # Mark as recently used
+            os.utime(filename)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+        return data
+
+    def put_data(self, key, data):
+        if self.path is None or len(data) > self.max_disk:
+            return
+
+        directory = self._disk_dir(key)
+        filename = os.path.join(directory, key.name)
+
+        with self._lock:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            # Drop stale versions
+            for entry in os.scandir(directory):
+                if entry.name.startswith(key.base) and entry.name != key.name and not entry.name.endswith(".tmp"):
+                    self._disk_unlink(entry.path)
+
+        # Write atomically, concurrent writers of the same key simply race for the rename
+        try:
+            fd, tmpname = tempfile.mkstemp(".tmp", key.name, directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            logger.warning("Could not write thumbnail %s: %s" % (filename, e))
+            return
+
+        with self._lock:
+            try:
+                old_size = os.path.getsize(filename)
+            except OSError:
+                old_size = 0
+            os.replace(tmpname, filename)
+            self.disk_size += len(data) - old_size
+
+            if self.disk_size > self.max_disk:
+                self._disk_evict()
+
+    def _disk_unlink(self, filename):
+        try:
+            size = os.path.getsize(filename)
+            os.unlink(filename)
+        except OSError:
+            return
+        self.disk_size -= size
+
+    def _disk_evict(self):
+        for _, size, filename in sorted(self._disk_files()):
+            if self.disk_size <= self.max_disk:
+                break
+            self._disk_unlink(filename)
+            self.evictions += 1
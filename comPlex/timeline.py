@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# ======================================================================
+# Plex Media Server protocol
+# ======================================================================
+# (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
+# ======================================================================
+# Playback progress reporting
+#
+# Players report as often as they like; only the latest position per item and state is sent,
+# every interval seconds from a background thread. State changes are sent right away.
+
+import logging
+import threading
+import concurrent.futures
+
+from .connection import ConnectionError
+
+logger = logging.getLogger("comPlex.timeline")
+
+PLAYING = "playing"
+PAUSED = "paused"
+STOPPED = "stopped"
+
+
+class TimelineEvent:
+    __slots__ = ("video", "time", "state")
+
+    def __init__(self, video, time, state):
+        self.video = video
+        self.time = time
+        self.state = state
+
+    @property
+    def key(self):
+        return self.video.key
+
+    @property
+    def progress(self):
+        duration = self.video.duration
+        return self.time / duration if duration else 0.0
+
+    @property
+    def path(self):
+        return "/:/timeline?ratingKey=%s&key=/library/metadata/%s&state=%s&time=%d&duration=%d" \
+               "&identifier=com.plexapp.plugins.library" % (self.key, self.key, self.state, self.time,
+                                                             self.video.duration or 0)
+
+
+def _append(events, event):
+    """ Queue event, replacing the last one if it has the same state """
+    if events and events[-1].state == event.state:
+        events[-1] = event
+    else:
+        events.append(event)
+
+
+class TimelineReporter:
+    """
+    Sends the playback progress of any number of videos to the server
+
+    update() only records the position and returns immediately. Events are sent every interval seconds,
+    at most max_parallel videos at a time; state changes wake the sender early. Consecutive events of a
+    ratingKey with the same state are merged into the newest one, state transitions are all sent in order. Once a video reaches threshold of its duration it is scrobbled, once per playback.
+    """
+
+    def __init__(self, connection, interval=10.0, threshold=0.9, max_parallel=2):
+        self.connection = connection
+        self.interval = interval
+        self.threshold = threshold
+        self.max_parallel = max_parallel
+
+        # ratingKey -> events to send in order, no two consecutive ones with the same state
+        self.pending = {}
+        # Last state sent per ratingKey
+        self.states = {}
+        self.scrobbled = set()
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def update(self, video, time, state=PLAYING):
+        """ Record the position of video in milliseconds """
+        if state == STOPPED and video.duration and time >= video.duration * 0.98:
+            # Players tend to stop a bit before the end
+            time = video.duration
+        event = TimelineEvent(video, int(time), state)
+        with self._lock:
+            if self._closed:
+                return
+            _append(self.pending.setdefault(event.key, []), event)
+            if state == PLAYING and event.key not in self.states:
+                self.scrobbled.discard(event.key)
+            if self.states.get(event.key) != state:
+                self._wake.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="comPlex timeline")
+                self._thread.start()
+
+    def stop(self, video, time):
+        self.update(video, time, STOPPED)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+            if self._closed:
+                return
+
+    def flush(self, deadline=None):
+        """ Send all pending events now """
+        with self._lock:
+            queues = list(self.pending.values())
+            self.pending.clear()
+        if not queues:
+            return
+        with concurrent.futures.ThreadPoolExecutor(min(self.max_parallel, len(queues))) as executor:
+            for events, unsent in zip(queues, executor.map(lambda q: self._send_all(q, deadline), queues)):
+                if unsent:
+                    with self._lock:
+                        # Retry with the next batch, ahead of anything that came in meanwhile
+                        queue = []
+                        for event in unsent + self.pending.get(events[0].key, []):
+                            _append(queue, event)
+                        self.pending[events[0].key] = queue
+
+    def _send_all(self, events, deadline=None):
+        """ Send the events of one video in order, returns those that weren't sent """
+        for i, event in enumerate(events):
+            error = self._send(event, deadline)
+            if error is not None:
+                logger.warning("Could not report progress of %s: %s" % (event.key, error))
+                return events[i:]
+        return []
+
+    def _send(self, event, deadline=None):
+        try:
+            self.connection.ping(event.path, deadline=deadline)
+        except ConnectionError as e:
+            return e
+
+        with self._lock:
+            if event.state == STOPPED:
+                self.states.pop(event.key, None)
+            else:
+                self.states[event.key] = event.state
+            scrobble = event.progress >= self.threshold and event.key not in self.scrobbled
+            if scrobble:
+                self.scrobbled.add(event.key)
+
+        if scrobble:
+            logger.info("Scrobbling %s at %d%%" % (event.key, event.progress * 100))
+            if self.connection.mutations is not None:
+                self.connection.mutations.mark_watched(event.video)
+                return
+            try:
+                self.connection.ping("/:/scrobble?key=%s&identifier=com.plexapp.plugins.library" % event.key,
+                                     deadline=deadline)
+            except ConnectionError as e:
+                with self._lock:
+                    self.scrobbled.discard(event.key)
+                return e
+            event.video.views += 1
+
+    def close(self, deadline=5.0):
+        """ Send what is left and stop the background thread """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wake.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(deadline)
+        # Events that arrived while the thread was already sending
+        self.flush(deadline)
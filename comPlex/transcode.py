@@ -5,19 +5,35 @@
 # (c) 2015      Taeyeon Mori <orochimarufan.x3@gmail.com>
 # ======================================================================
 
+import atexit
+import signal
+import logging
+import weakref
+import threading
+import collections
 from uuid import uuid4
-import urllib.parse
 
 from .dt import OperationObject, OptionAttrib
 
+logger = logging.getLogger("comPlex.transcode")
+
 
 class TranscodeSession(OperationObject):
+    """
+    A universal transcode session
+
+    With ext="m3u8" the session is started in HLS mode (protocol=hls) and path points to
+    its playlist, see comPlex.hls for playing it.
+    """
+
     def __init__(self, conn, session=None, ext="ts", **opts):
         super().__init__(conn)
 
         if session is None:
             session = uuid4()
 
+        if ext == "m3u8":
+            self.options["protocol"] = "hls"
         self.options.update(opts)
         self.options["session"] = session
 
@@ -25,19 +41,192 @@ class TranscodeSession(OperationObject):
 
     uuid = OptionAttrib("session")
 
+    @property
+    def hls(self):
+        return self.options.get("protocol") == "hls"
+
     @property
     def path(self):
-        parms = dict(self.connection.client.plex_headers)
-        parms.update(self.options)
-        return "/video/:/transcode/universal/start.%s?%s" % (self.ext, urllib.parse.urlencode(parms))
+        return "/video/:/transcode/universal/start.%s?%s&%s" % (
+            self.ext, self.connection.client.plex_query, self.urlencode())
 
     @property
     def url(self):
         return self.connection.get_url(self.path)
 
-    def stop(self):
-        return self.connection.ping('/video/:/transcode/universal/stop?session=%s' % self.uuid)
+    def ping(self, deadline=5.0):
+        """ Keep the session alive, the server stops idle transcodes after a while """
+        return self.connection.ping('/video/:/transcode/universal/ping?session=%s' % self.uuid, deadline=deadline)
+
+    def stop(self, deadline=None):
+        return self.connection.ping('/video/:/transcode/universal/stop?session=%s' % self.uuid, deadline=deadline)
 
     @classmethod
     def from_library(cls, video, session=None, ext="ts", **b):
         return cls(video.connection, session, ext, path="http://127.0.0.1:32400%s" % video.path, **b)
+
+
+class TranscodeManager:
+    """
+    Keeps track of the transcode sessions started by this client
+
+    Registered sessions are pinged every keepalive seconds from a background thread.
+    At most max_sessions run at once, starting another one stops the oldest. Sessions still
+    registered when the interpreter exits (or is terminated by SIGTERM/SIGHUP) are stopped.
+
+    Session ids start with the client identifier, so sessions left behind by an earlier run
+    can be found in /transcode/sessions and stopped with kill_orphans().
+    """
+
+    def __init__(self, connection, max_sessions=2, keepalive=30.0):
+        self.connection = connection
+        self.max_sessions = max_sessions
+        self.keepalive = keepalive
+
+        self.sessions = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        _managers.add(self)
+        _install_cleanup()
+
+    @property
+    def prefix(self):
+        return "%s-" % self.connection.client.ClientIdentifier
+
+    def create(self, video, ext="ts", **opts):
+        """
+        Start a new transcode session for a library video
+
+        maxVideoBitrate, videoResolution and videoQuality default to what the connection's
+        measured bandwidth allows.
+        """
+        for name, value in self.connection.bandwidth.transcode_options(self.connection.local).items():
+            opts.setdefault(name, value)
+        session = TranscodeSession.from_library(video, "%s%s" % (self.prefix, uuid4()), ext, **opts)
+        self.register(session)
+        return session
+
+    def register(self, session):
+        with self._lock:
+            while len(self.sessions) >= self.max_sessions:
+                _, oldest = self.sessions.popitem(last=False)
+                logger.info("Too many transcode sessions, stopping %s" % oldest.uuid)
+                self._stop_session(oldest)
+            self.sessions[str(session.uuid)] = session
+
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True, name="comPlex transcode keepalive")
+                self._thread.start()
+
+    def release(self, session):
+        """ Stop a session and forget about it """
+        with self._lock:
+            self.sessions.pop(str(session.uuid), None)
+        self._stop_session(session)
+
+    def _stop_session(self, session, deadline=None):
+        try:
+            session.stop(deadline)
+        except Exception as e:
+            logger.warning("Could not stop transcode session %s: %s" % (session.uuid, e))
+
+    def ping_all(self):
+        with self._lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            try:
+                session.ping()
+            except Exception as e:
+                logger.warning("Keepalive for transcode session %s failed: %s" % (session.uuid, e))
+
+    def _run(self):
+        while not self._stop.wait(self.keepalive):
+            self.ping_all()
+
+    def stop_all(self, deadline=None):
+        with self._lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            self._stop_session(session, deadline)
+
+    def close(self, deadline=5.0):
+        """ Stop all sessions and the keepalive thread, giving up on each session after deadline seconds """
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            # A keepalive ping may be in flight
+            self._thread.join(deadline)
+        self._thread = None
+        self.stop_all(deadline)
+        _managers.discard(self)
+
+    # Server-side sessions
+    def server_sessions(self, deadline=5.0):
+        """ The TranscodeSession elements the server has for this client """
+        prefix = self.prefix
+        return [xml for xml in self.connection.xml("/transcode/sessions", deadline=deadline).getroot()
+                if xml.get("key", "").rpartition("/")[2].startswith(prefix)]
+
+    def kill(self, key, deadline=5.0):
+        """ Stop a server-side session by its key """
+        key = key.rpartition("/")[2]
+        with self._lock:
+            self.sessions.pop(key, None)
+        return self.connection.ping('/video/:/transcode/universal/stop?session=%s' % key, deadline=deadline)
+
+    def kill_orphans(self, deadline=5.0):
+        """ Stop server-side sessions of this client that aren't registered, returns their keys """
+        with self._lock:
+            known = set(self.sessions)
+        killed = []
+        for xml in self.server_sessions(deadline):
+            key = xml.get("key").rpartition("/")[2]
+            if key not in known:
+                logger.info("Stopping orphaned transcode session %s" % key)
+                self.kill(key, deadline)
+                killed.append(key)
+        return killed
+
+
+# Cleanup on exit
+_managers = weakref.WeakSet()
+_cleanup_installed = False
+
+
+def _cleanup():
+    for manager in list(_managers):
+        manager.close()
+
+
+def _install_cleanup():
+    global _cleanup_installed
+    if _cleanup_installed:
+        return
+    _cleanup_installed = True
+
+    atexit.register(_cleanup)
+
+    # Signal handlers can only be set from the main thread
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    for signum in (signal.SIGTERM, getattr(signal, "SIGHUP", None)):
+        if signum is None:
+            continue
+        previous = signal.getsignal(signum)
+        if previous is signal.SIG_IGN:
+            continue
+
+        def handler(signum, frame, previous=previous):
+            _cleanup()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                # Restore the default action and re-raise
+                signal.signal(signum, signal.SIG_DFL)
+                signal.raise_signal(signum)
+
+        signal.signal(signum, handler)